@@ -7,6 +7,13 @@ import time
 from Face_Alignt.matlab_cp2tform import get_similarity_transform_for_cv2
 from PIL import Image
 import math
+from numpy.lib.stride_tricks import as_strided
+from utils.nms import nms_tensor
+from utils.detection import make_detections, empty_detections, source_scale
+from mtcnn_pytorch.src.align_trans import get_reference_facial_points, similarity_transforms, warp_faces, align_faces
+
+# the 112x112 reference points alignment() uses
+REFERENCE_POINTS = get_reference_facial_points(default_square=True)
 def alignment(src_img, src_pts, default_square = True):
     ref_pts = np.array([[30.2946, 51.6963],
       [65.5318, 51.5014],
@@ -51,86 +58,77 @@ def get_anchors(scale=64):
         u_boxes:tensor([anchor_num,4]) (cx,cy,w,h): real anchors
         boxes:tensor([anchor_num,4]) (x1,y1,x2,y2): crop box for ONet,each with size 80
     '''
-    sizes = [float(s) / scale for s in [32]]
-    
-    aspect_ratios = [(1.,)]
-    feature_map_sizes = [int(scale/16)]
-    
-    num_layers = len(feature_map_sizes)
-    u_boxes,boxes = [],[]
-    for i in range(num_layers):
-        fmsize = feature_map_sizes[i]
-        for h,w in itertools.product(range(fmsize),repeat=2):
-            cx = float(w)/feature_map_sizes[i]
-            cy = float(h)/feature_map_sizes[i]
-            
-            s = sizes[i]
-            for j,ar in enumerate(aspect_ratios[i]):
-                u_boxes.append((cx,cy,float(s)*ar,float(s)*ar))
-                boxes.append((w*16-32,h*16-32,w*16+32,h*16+32))       
-    return torch.Tensor(u_boxes),torch.Tensor(boxes).long()
+    fmsize = int(scale/16)
+    s = 32. / scale
+    # one anchor per feature map cell, rows first like itertools.product(range(fmsize),repeat=2)
+    h, w = np.meshgrid(np.arange(fmsize), np.arange(fmsize), indexing='ij')
+    h, w = h.reshape(-1), w.reshape(-1)
+    u_boxes = np.stack([w / float(fmsize), h / float(fmsize), np.full(len(w), s), np.full(len(w), s)], 1)
+    boxes = np.stack([w*16-32, h*16-32, w*16+32, h*16+32], 1)
+    return torch.Tensor(u_boxes),torch.from_numpy(boxes).long()
 
 def nms(bboxes,scores,threshold=0.35):
     '''
         bboxes(tensor) [N,4]
         scores(tensor) [N,]
     '''
-    x1 = bboxes[:,0]
-    y1 = bboxes[:,1]
-    x2 = bboxes[:,2]
-    y2 = bboxes[:,3]
-    areas = (x2-x1) * (y2-y1)
-
-    _,order = scores.sort(0,descending=True)
-    keep = []
-    while order.numel() > 0:
-        if order.numel() == 1:
-            i = order.item()
-        else:
-            i = order[0].item()
-        keep.append(i) 
-
-        if order.numel() == 1:
-            break 
-
-        xx1 = x1[order[1:]].clamp(min=x1[i]) 
-        yy1 = y1[order[1:]].clamp(min=y1[i])
-        xx2 = x2[order[1:]].clamp(max=x2[i])
-        yy2 = y2[order[1:]].clamp(max=y2[i])
-
-        w = (xx2-xx1).clamp(min=0)
-        h = (yy2-yy1).clamp(min=0)
-        inter = w*h
-
-        ovr = inter / (areas[i] + areas[order[1:]] - inter) 
-        ids = (ovr<=threshold).nonzero().squeeze()
-        if ids.numel() == 0:
-            break
-        order = order[ids+1] 
-    return torch.LongTensor(keep)
+    return nms_tensor(bboxes, scores, threshold)
     
-def decode_box(loc, size=64):
+def decode_box(loc, size=64, anchor=None, crop=None):
+    '''
+    anchor, crop : precomputed get_anchors output for loc, built from size when not given
+    '''
     variances = [0.1,0.2]
-    anchor,crop = get_anchors(scale=size)
+    if anchor is None:
+        anchor,crop = get_anchors(scale=size)
     cxcy = loc[:,:2] * variances[0] * anchor[:,2:] + anchor[:,:2]
     wh = torch.exp(loc[:,2:] * variances[1]) * anchor[:,2:]
     boxes = torch.cat([cxcy-wh/2,cxcy+wh/2],1)
     
     return boxes,anchor,crop
-    
+
+# x and y columns of the 10 landmark values
+LDMK_X = torch.LongTensor([0,2,4,6,8])
+LDMK_Y = torch.LongTensor([1,3,5,7,9])
+
 def decode_ldmk(ldmk,anchor):
     variances = [0.1,0.2]
-    index_x = torch.Tensor([0,2,4,6,8]).long()
-    index_y = torch.Tensor([1,3,5,7,9]).long()
-    ldmk[:,index_x] = ldmk[:,index_x] * variances[0] * anchor[:,2].view(-1,1) + anchor[:,0].view(-1,1)
-    ldmk[:,index_y] = ldmk[:,index_y] * variances[0] * anchor[:,3].view(-1,1) + anchor[:,1].view(-1,1)
+    ldmk[:,LDMK_X] = ldmk[:,LDMK_X] * variances[0] * anchor[:,2].view(-1,1) + anchor[:,0].view(-1,1)
+    ldmk[:,LDMK_Y] = ldmk[:,LDMK_Y] * variances[0] * anchor[:,3].view(-1,1) + anchor[:,1].view(-1,1)
     return ldmk
     
+def gather_crops(img_pyramid, crops, which, crop_size=64, pad=32, fill=128):
+    '''
+    img_pyramid : list of [s, s, 3] uint8 pyramid images
+    crops : [n, 4] int (x1, y1, x2, y2) crop boxes in level coordinates
+    which : [n] int pyramid level of every crop
+    return : [n, 3, crop_size, crop_size] float32 ONet batch, fill outside the level
+    '''
+    crops, which = np.asarray(crops).reshape(-1, 4), np.asarray(which)
+    batch = np.empty((len(crops), img_pyramid[0].shape[2], crop_size, crop_size), dtype=np.float32)
+    for level in np.unique(which):
+        mask = which == level
+        # every crop box of a level lies inside the level padded by pad pixels
+        padded = cv2.copyMakeBorder(img_pyramid[level], pad, pad, pad, pad, cv2.BORDER_CONSTANT, value=(fill,)*3)
+        h, w, c = padded.shape
+        sy, sx, sc = padded.strides
+        # [y, x, 3, crop, crop] view of every window, one gather copies all crops of the level
+        windows = as_strided(padded, shape=(h - crop_size + 1, w - crop_size + 1, c, crop_size, crop_size), strides=(sy, sx, sc, sy, sx))
+        batch[mask] = windows[crops[mask, 1] + pad, crops[mask, 0] + pad]
+    return batch
+
 import os
 # list_per = []
 
 import glob, tqdm
+# input sizes of the P-Net image pyramid
+PYRAMID_SIZES = (32, 64, 128, 256, 512)
 class Face_Alignt():
+    # what detect_align uses for None
+    default_min_face_size = 50.0
+    default_thresholds = [0.6, 0.87]
+    default_nms_thresholds = [0.35]
+
     def __init__(self, use_gpu = False):
         self.pnet, self.onet = PNet(),ONet() 
         self.pnet.load_state_dict(torch.load('Face_Alignt/weight/msos_pnet_rotate.pt',map_location=lambda storage, loc:storage), strict=False) 
@@ -139,24 +137,59 @@ class Face_Alignt():
         self.pnet.eval()
         self.onet.eval()
         self.use_gpu = use_gpu
+        self._decode_cache = {}
         if self.use_gpu:
             torch.cuda.set_device(0)
             self.pnet.cuda()
             self.onet.cuda()
-        else:
-            torch.set_num_threads(1)
-    def align_multi(self, img, limit=None, min_face_size=30.0):
-        boxes, faces =self.detect(img)
+    def decode_tables(self, sizes=PYRAMID_SIZES):
+        '''
+        anchors, ONet crop boxes and pyramid level of every P-Net output over the
+        given pyramid sizes, concatenated in level order and built once per instance
+        '''
+        sizes = tuple(sizes)
+        if sizes not in self._decode_cache:
+            anchors, crops, which = [], [], []
+            for level, size in enumerate(sizes):
+                anchor, crop = get_anchors(scale=size)
+                anchors.append(anchor)
+                crops.append(crop)
+                which.append(torch.full((len(anchor),), level, dtype=torch.long))
+            self._decode_cache[sizes] = torch.cat(anchors), torch.cat(crops), torch.cat(which)
+        return self._decode_cache[sizes]
+
+    def align_multi(self, img, limit=None, min_face_size=None, thresholds=None, nms_thresholds=None, as_tensor=False, source=None):
+        boxes, faces =self.detect(img, limit, min_face_size, thresholds, nms_thresholds, as_tensor=as_tensor, source=source)
         return boxes, faces
     def align(self, img):
         boxes, faces = self.detect(img)
         if len(faces) > 0:
             return faces[0]
         return None
-    def detect(self, file, limit=None, min_face_size=30.0):
+    def detect(self, file, limit=None, min_face_size=None, thresholds=None, nms_thresholds=None, as_tensor=False, source=None):
+        '''
+        return : boxes [n, 5] (x1, y1, x2, y2, score) and the faces as a list of PIL Image,
+                 or as one normalized [n, 3, 112, 112] tensor with as_tensor
+        '''
+        detections = self.detect_align(file, limit, min_face_size, thresholds, nms_thresholds, as_tensor, source)
+        boxes = np.concatenate([detections.boxes, detections.scores[:, None]], 1)
+        if as_tensor:
+            return boxes, detections.faces
+        return boxes, [Image.fromarray(face) for face in detections.faces]
+    def detect_align(self, file, limit=None, min_face_size=None, thresholds=None, nms_thresholds=None, as_tensor=False, source=None):
+        '''
+        utils.detection protocol
+        thresholds : [P-Net face probability, final score], nms_thresholds : [P-Net nms]
+        min_face_size : smallest width of the returned (5 pixel padded) box
+        source : full resolution image file was downscaled from, the boxes are mapped
+                 onto it and the faces are cut from it
+        return : Detections with boxes, scores, landmarks and the aligned faces as arrays
+        '''
+        min_face_size = min_face_size or self.default_min_face_size
+        thresholds = thresholds or self.default_thresholds
+        nms_thresholds = nms_thresholds or self.default_nms_thresholds
         def change(boxes,ldmks, h, w, pad1):
-            index_x = torch.LongTensor([0,2,4,6,8])
-            index_y = torch.LongTensor([1,3,5,7,9])
+            index_x, index_y = LDMK_X, LDMK_Y
             if h <= w:
                 boxes[:,1] = boxes[:,1]*w-pad1
                 boxes[:,3] = boxes[:,3]*w-pad1
@@ -181,7 +214,7 @@ class Face_Alignt():
                 im = np.array(file)
         if im is None:
             print("can not open image:", file)
-            return
+            return empty_detections(as_tensor=as_tensor)
 
         # pad img to square
         h, w,_ = im.shape
@@ -198,14 +231,12 @@ class Face_Alignt():
             img_size /= 2
             if img_scale == 6:
                 break
-        img_size = 32
         img_pyramid = []
-        t_boxes,t_probs, t_anchors, t_crops, t_which = None, None, None, None, None
-        
-        for scale in range(5):
+        locs, confs = [], []
+        for img_size in PYRAMID_SIZES:
             # print('scale:{0} img_size:{1}'.format(scale, img_size))
             input_img = cv2.resize(img,(img_size, img_size))
-            img_pyramid.append(input_img.transpose(2,0,1))
+            img_pyramid.append(input_img)
             im_tensor = torch.from_numpy(input_img.transpose(2,0,1)).float()
             if self.use_gpu:
                 im_tensor = im_tensor.cuda()
@@ -217,81 +248,70 @@ class Face_Alignt():
                 torch.cuda.synchronize()
         
             # print('forward time:{}s'.format(e_t-s_t))        
-            loc, conf = loc.detach().cpu(),conf.detach().cpu()
-            loc, conf = loc.data.squeeze(0),F.softmax(conf.squeeze(0))
-            boxes, anchor, crop = decode_box(loc,size=img_size)
-            which_img = torch.tensor([scale]).long().expand((crop.shape[0],))
-            
-            #add box into stack
-            if scale == 0:
-                t_boxes, t_confs, t_anchors, t_crops, t_which = boxes, conf, anchor, crop, which_img
-            else:
-                t_boxes = torch.cat((t_boxes, boxes),0)
-                t_confs = torch.cat((t_confs, conf),0)
-                t_anchors = torch.cat((t_anchors, anchor),0)
-                t_crops = torch.cat((t_crops, crop),0)
-                t_which = torch.cat((t_which, which_img),0)
-            img_size *= 2
+            locs.append(loc.detach().cpu().squeeze(0))
+            confs.append(conf.detach().cpu().squeeze(0))
+
+        #decode every level in one pass against the cached anchors
+        t_anchors, t_crops, t_which = self.decode_tables(PYRAMID_SIZES)
+        t_boxes, _, _ = decode_box(torch.cat(locs), anchor=t_anchors, crop=t_crops)
+        t_confs = F.softmax(torch.cat(confs), dim=1)
 
         #get right boxes and nms
-        t_confs[:,0] = 0.6
+        t_confs[:,0] = thresholds[0]
         max_conf, labels = t_confs.max(1)
-        if labels.long().sum().item() is 0:
-            return None
+        if labels.long().sum().item() == 0:
+            return empty_detections(channels=im.shape[2], as_tensor=as_tensor)
         ids = labels.nonzero().squeeze(1)
         t_boxes, t_confs, t_anchors, t_crops, t_which = t_boxes[ids], t_confs[ids], t_anchors[ids], t_crops[ids], t_which[ids]
         max_conf = max_conf[ids]
         
-        keep = nms(t_boxes, max_conf)
+        keep = nms(t_boxes, max_conf, nms_thresholds[0])
         t_boxes, max_conf, t_anchors, t_crops, t_which = t_boxes[keep], max_conf[keep], t_anchors[keep], t_crops[keep], t_which[keep]
 
         t_boxes = t_boxes.detach().numpy()
         max_conf = max_conf.detach().numpy()
         
         #get crop and ldmks
-        crop_imgs = []
-        for i in range(t_boxes.shape[0]):
-            img = img_pyramid[t_which[i]]
-            crop = t_crops[i].numpy()
-            _,h_,w_ = img.shape
-            o_x1,o_y1,o_x2,o_y2 = max(crop[0],0),max(crop[1],0),min(crop[2],w_),min(crop[3],h_)
-            c_x1 = 0 if crop[0] >=0 else -crop[0]
-            c_y1 = 0 if crop[1] >=0 else -crop[1]
-            c_x2 = 64 if crop[2] <= w_ else 64 - (crop[2] - w_)
-            c_y2 = 64 if crop[3] <= h_ else 64 - (crop[3] - h_)
-            crop_img = np.ones((3,64,64))*128
-            np.copyto(crop_img[:,c_y1:c_y2,c_x1:c_x2],img[:,o_y1:o_y2,o_x1:o_x2])
-            crop_imgs.append(crop_img)
-        crop_imgs = torch.from_numpy(np.array(crop_imgs)).float()
+        crop_imgs = torch.from_numpy(gather_crops(img_pyramid, t_crops.numpy(), t_which.numpy()))
         if self.use_gpu:
             crop_imgs = crop_imgs.cuda()
         t_ldmks = self.onet(crop_imgs).detach().cpu()[:,10,:].squeeze(1)
         t_ldmks = decode_ldmk(t_ldmks, t_anchors)
         t_boxes, t_ldmks = change(t_boxes,t_ldmks, h, w, pad1)
-        r_faces = []
+        if source is not None:
+            # found on the proxy, carried over to the original pixels
+            sx, sy = source_scale(im, np.asarray(source))
+            t_boxes[:,[0,2]] *= sx
+            t_boxes[:,[1,3]] *= sy
+            t_ldmks[:,LDMK_X] *= sx
+            t_ldmks[:,LDMK_Y] *= sy
+            im = np.asarray(source)
+        r_ldmks = []
         r_bboxes = []
-        if limit is None:
-            num_face = len(t_boxes)
-        else:
-            num_face = min(len(t_boxes) + 1, limit)
-        for i in range(num_face):
-
+        for i in range(len(t_boxes)):
+            if limit is not None and len(r_bboxes) == limit:
+                break
             box, prob, ldmk = t_boxes[i], max_conf[i], t_ldmks[i]
-            if prob <= 0.87:
+            if prob <= thresholds[1]:
                 continue
             ldmk_fn = ldmk.reshape(5,2)
             x1 = max(int(box[0]) - 5, 0)
             x2 = min(int(box[2]) + 5, im.shape[1])
             y1 = max(int(box[1])- 5, 0)
             y2 = min(int(box[3]) + 5, im.shape[0])
-            if x2-x1 < 50:
+            if x2-x1 < min_face_size:
                 continue
-            bbox = [x1, y1, x2, y2, prob]
-            r_bboxes.append(bbox)
-            face = alignment(im, ldmk_fn)
+            r_bboxes.append([x1, y1, x2, y2, prob])
+            r_ldmks.append(ldmk_fn.numpy())
             # cv2.rectangle(im, (x1,y1),(x2,y2), (255,0,0), 1)
             # cv2.imwrite('a.png',im)  
-            r_faces.append(Image.fromarray(face))
-        return np.array(r_bboxes), r_faces
+        # align every kept face in one batch
+        r_bboxes = np.array(r_bboxes, dtype=np.float32).reshape(-1, 5)
+        r_ldmks = np.array(r_ldmks, dtype=np.float64).reshape(-1, 5, 2)
+        if as_tensor:
+            faces = align_faces(im, r_ldmks, REFERENCE_POINTS)
+        else:
+            faces = warp_faces(im, similarity_transforms(r_ldmks, REFERENCE_POINTS))
+        return make_detections(r_bboxes[:, :4], r_bboxes[:, 4], r_ldmks, faces)
 # Face_Alignt = Face_Alignt()
 # Face_Alignt.align('PQH_0000.png').convert('RGB').save('a.png', "JPEG")
\ No newline at end of file
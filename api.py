@@ -6,13 +6,20 @@ from torchvision import transforms as trans
 import math
 from align_v2 import Face_Alignt
 from mtcnn import MTCNN
-from utils.utils import load_facebank, prepare_facebank, prepare_facebank_np
+from utils.utils import load_facebank, prepare_facebank, prepare_facebank_np, embed_faces
+from utils.facebank import update_facebank_incremental, FacebankBuilder
+from utils.matching import nearest_numpy, nearest_tensor, topk_numpy, topk_tensor
+from utils.ivfpq import IVFPQIndex
+from utils.facebank_store import NamesTable
+from batcher import EmbeddingBatcher
+from utils.threads import configure_threads, use_torch_threads, DetectionExecutor
+from utils.detection import detection_proxy
 import os
 class face_recognize(object):
     def __init__(self, conf):
         self.conf = conf
         if conf.use_mobilfacenet:
-            self.model = MobileFaceNet(512).to(conf.device)
+            self.model = MobileFaceNet(conf.embedding_size).to(conf.device)
         else:
             self.model = SE_IR(50, 0.4, conf.net_mode).to(conf.device)
         self.use_tensor = conf.use_tensor     #If False: su dung numpy dung cho tuong lai khi trien khai qua Product Quantizers cho he thong lon
@@ -20,13 +27,17 @@ class face_recognize(object):
         
 
         self.model.eval()
+        self.threads = configure_threads(conf)
+        self.detect_executor = None
+        if self.threads['detect_workers'] > 0:
+            self.detect_executor = DetectionExecutor(self.threads['detect_workers'], self.threads['detect_threads'])
         self.threshold = conf.threshold
         self.test_transform = conf.test_transform
         if conf.use_mtcnn:
             self.mtcnn = MTCNN()
         else:
             use_gpu = False
-            if not conf.device == 'cpu':
+            if conf.device.type != 'cpu':
                 use_gpu = True
             self.mtcnn = Face_Alignt(use_gpu = use_gpu)
         self.tta = True
@@ -35,6 +46,7 @@ class face_recognize(object):
         self.embeddings = None
         self.names = None
         self.with_facebank = False
+        self.batcher = None
         self.load_state(conf.device.type)
 
     def load_state(self, device='cpu'): 
@@ -54,9 +66,7 @@ class face_recognize(object):
         self.names = np.load('%s/names.npy'%self.conf.facebank_path)
 
     def _raw_load_single_face(self, image, name='Unknow'):
-        embeddings = []
         names = ['Unknown']
-        embs = []
         assert not image is None, 'None is not image, please enter image path!'
         try:
             if isinstance(image, np.ndarray):
@@ -69,32 +79,25 @@ class face_recognize(object):
         except:
             pass
         if img.size != (112, 112):
-            img = self.mtcnn.align(img)
-        with torch.no_grad():
-            if self.tta:
-                mirror = trans.functional.hflip(img)
-                emb = self.model(self.test_transform(img).to(self.conf.device).unsqueeze(0))
-                emb_mirror = self.model(self.test_transform(mirror).to(self.conf.device).unsqueeze(0))
-                if self.use_tensor:
-                    embs.append(l2_norm(emb + emb_mirror))
-                else:
-                    embs.append(l2_norm(emb + emb_mirror).data.cpu().numpy())
-            else:                        
-                embs.append(self.model(self.test_transform(img).to(self.conf.device).unsqueeze(0)))
-        if not len(embs) == 0:
-            names.append(name)
-            names = np.array(names)
-            if self.use_tensor:
-                embedding = torch.cat(embs).mean(0,keepdim=True)
-                embeddings.append(embedding)
-                embeddings = torch.cat(embeddings)
-            else:
-                embedding = np.mean(embs,axis=0)
-                embeddings.append(embedding[0])
+            img = self.align(img)
+        names.append(name)
+        names = np.array(names)
+        embedding = self.embed_tensor([img])
+        if self.use_tensor:
+            embeddings = embedding
+        else:
+            embeddings = [embedding[0].data.cpu().numpy()]
 
         return embeddings, names
             
-    def update_facebank(self):
+    def update_facebank(self, incremental=False):
+        if self.conf.facebank_workers > 0:
+            builder = FacebankBuilder(self.conf, self.model, self.tta, self.conf.facebank_workers)
+            if incremental:
+                return update_facebank_incremental(self.conf, self.model, self.mtcnn, self.tta, embed_files=builder.embed_files)
+            return builder.build()
+        if incremental:
+            return update_facebank_incremental(self.conf, self.model, self.mtcnn, self.tta)
         if self.use_tensor:
             embeddings, names = prepare_facebank(self.conf, self.model, self.mtcnn, self.tta)
         else:
@@ -105,14 +108,125 @@ class face_recognize(object):
         embeddings, names = load_facebank(self.conf)
         return embeddings, names
 
-    def align_multi(self, img, thresholds = [0.3, 0.6, 0.8], nms_thresholds=[0.6, 0.6, 0.6]):
-        bboxes, faces = self.mtcnn.align_multi(img, self.limit, self.min_face_size, thresholds = thresholds, nms_thresholds = nms_thresholds)
+    def build_index(self, embeddings, save=True):
+        '''
+        train an IVFPQIndex over the facebank embeddings for approximate search in infer_numpy,
+        small facebanks get fewer lists and codewords (IVFPQIndex.train)
+        '''
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        index = IVFPQIndex(embeddings.shape[1], self.conf.pq_nlist, self.conf.pq_m, self.conf.pq_nbits, self.conf.pq_nprobe)
+        index.train(embeddings)
+        index.add(embeddings)
+        if save:
+            index.save(self.conf.pq_index_path)
+        return index
+
+    def load_index(self):
+        return IVFPQIndex.load(self.conf.pq_index_path)
+
+    def _detect(self, fn, *args, **kwargs):
+        '''
+        run a detector call on the detection executor when there is one, else on this thread
+        with its share of the cores
+        '''
+        if self.detect_executor is not None:
+            return self.detect_executor.run(fn, *args, **kwargs)
+        use_torch_threads(self.threads['caller_threads'])
+        return fn(*args, **kwargs)
+
+    def _proxy(self, img):
+        '''
+        return : (detector input, source), a proxy downscaled to conf.detect_max_side and img
+                 itself as the source of the crops when img is larger, else (img, None)
+        '''
+        if isinstance(img, str):
+            return img, None
+        proxy = detection_proxy(img, self.conf.detect_max_side)
+        if proxy is img:
+            return img, None
+        return proxy, img
+
+    def detect_align(self, img, thresholds = None, nms_thresholds=None, as_tensor=False):
+        '''
+        return : utils.detection.Detections (boxes, scores, landmarks, faces as arrays)
+                 of the configured detector, empty when there is no face
+        thresholds, nms_thresholds : per detector stage, None takes the detector defaults
+        '''
+        img, source = self._proxy(img)
+        return self._detect(self.mtcnn.detect_align, img, self.limit, self.min_face_size, thresholds = thresholds, nms_thresholds = nms_thresholds,
+                            as_tensor = as_tensor, source = source)
+
+    def align_multi(self, img, thresholds = None, nms_thresholds=None, as_tensor=False):
+        '''
+        as_tensor : faces come back as one normalized [n, 3, 112, 112] tensor that
+                    infer / embed take directly, instead of a list of PIL Image
+        thresholds, nms_thresholds : per detector stage, None takes the detector defaults
+        '''
+        img, source = self._proxy(img)
+        bboxes, faces = self._detect(self.mtcnn.align_multi, img, self.limit, self.min_face_size, thresholds = thresholds, nms_thresholds = nms_thresholds,
+                                     as_tensor = as_tensor, source = source)
         return bboxes, faces
 
-    def align(img):
-        face = self.mtcnn.align(img)
+    def align_multi_batch(self, imgs, thresholds = None, nms_thresholds=None, as_tensor=False):
+        '''
+        align_multi for a list of images, return : list of (bboxes, faces) per image
+        MTCNN detects the whole list batched, other detectors go image by image
+        '''
+        if self.conf.use_mtcnn:
+            proxies, sources = zip(*[self._proxy(img) for img in imgs]) if len(imgs) > 0 else ([], [])
+            return self._detect(self.mtcnn.align_multi_batch, list(proxies), self.limit, self.min_face_size, thresholds = thresholds, nms_thresholds = nms_thresholds,
+                                                max_batch_pixels = self.conf.detect_batch_pixels, as_tensor = as_tensor, sources = list(sources))
+        return [self.align_multi(img, thresholds = thresholds, nms_thresholds = nms_thresholds, as_tensor = as_tensor) for img in imgs]
+
+    def align(self, img):
+        face = self._detect(self.mtcnn.align, img)
         return face
 
+    def warm_up(self):
+        '''
+        run one dummy detection and one dummy forward so the first real request
+        does not pay for lazy allocations inside torch
+        '''
+        image = Image.new('RGB', (self.conf.input_size[1]*4, self.conf.input_size[0]*4), (128, 128, 128))
+        try:
+            self.align_multi(image)
+        except:
+            pass
+        self.embed_tensor(torch.zeros([1, 3] + self.conf.input_size))
+
+    def enable_batching(self):
+        '''
+        route infer through one EmbeddingBatcher so faces from concurrent callers share forwards
+        '''
+        if self.batcher is None:
+            self.batcher = EmbeddingBatcher(self._embed_batch, self.conf.embed_batch_size, self.conf.embed_max_wait,
+                                            self.threads['embed_threads'])
+        return self.batcher
+
+    def _embed_batch(self, batch):
+        return embed_faces(self.conf, self.model, batch, self.tta)
+
+    def embed_tensor(self, faces):
+        '''
+        faces : list of PIL Image or a [n, 3, 112, 112] tensor normalized by test_transform
+        return : [n, 512] embeddings tensor, faces and their mirrors share one forward
+        '''
+        if self.batcher is not None:
+            if not isinstance(faces, torch.Tensor):
+                if len(faces) == 0:
+                    return torch.zeros((0, self.conf.embedding_size))
+                faces = torch.stack([self.test_transform(img) for img in faces])
+            return self.batcher.embed(faces)
+        use_torch_threads(self.threads['caller_threads'])
+        return embed_faces(self.conf, self.model, faces, self.tta)
+
+    def embed(self, faces):
+        '''
+        faces : list of PIL Image or a [n, 3, 112, 112] tensor normalized by test_transform
+        return : [n, 512] float32 numpy array
+        '''
+        return self.embed_tensor(faces).data.cpu().numpy()
+
     def infer(self, faces, target_embs):
         if self.use_tensor:
             min_idx, minimum, source_embs = self.infer_tensor(faces, target_embs)
@@ -120,56 +234,70 @@ class face_recognize(object):
             min_idx, minimum, source_embs = self.infer_numpy(faces, target_embs)
         return min_idx, minimum, source_embs
 
-    def infer_tensor(self, faces, target_embs):
+    @staticmethod
+    def _lookup_names(names, idx):
+        if isinstance(names, NamesTable):
+            return names[idx]
+        return np.asarray(names)[idx]
+
+    def identify(self, faces, target_embs, names, k=5):
         '''
         faces : list of PIL Image
+        target_embs : [m, 512] computed embeddings of faces in facebank, or an IVFPQIndex when not use_tensor
+        names : recorded names of faces in facebank, names[0] is 'Unknown'
+        k : number of candidates per face
+        return : topk_idx [n, k], topk_names [n, k], topk_dist [n, k] nearest first,
+                 candidates farther than self.threshold are not matches
+        '''
+        if self.use_tensor:
+            return self.search(self.embed_tensor(faces), target_embs, names, k)
+        return self.search(self.embed(faces), target_embs, names, k)
+
+    def search(self, source_embs, target_embs, names, k=5):
+        '''
+        identify for embeddings computed already
+        source_embs : [n, 512] l2 normalized embeddings, tensor or numpy array
+        '''
+        if self.use_tensor:
+            if not isinstance(source_embs, torch.Tensor):
+                source_embs = torch.from_numpy(np.asarray(source_embs, dtype=np.float32)).to(target_embs.device)
+            topk_idx, topk_dist = topk_tensor(source_embs, target_embs, k, self.conf.match_row_block, self.conf.match_col_block)
+            topk_names = self._lookup_names(names, topk_idx.cpu().numpy() + 1)
+        else:
+            if isinstance(source_embs, torch.Tensor):
+                source_embs = source_embs.data.cpu().numpy()
+            if isinstance(target_embs, IVFPQIndex):
+                topk_dist, topk_idx = target_embs.search(source_embs, k)
+            else:
+                topk_idx, topk_dist = topk_numpy(source_embs, target_embs, k, self.conf.match_row_block, self.conf.match_col_block)
+            topk_names = self._lookup_names(names, topk_idx + 1)
+        return topk_idx, topk_names, topk_dist
+
+    def infer_tensor(self, faces, target_embs):
+        '''
+        faces : list of PIL Image or a normalized [n, 3, 112, 112] tensor from align_multi(as_tensor=True)
         target_embs : [n, 512] computed embeddings of faces in facebank
         names : recorded names of faces in facebank
         tta : test time augmentation (hfilp, that's all)
         '''
-        embs = []
-        for img in faces:
-            if self.tta:
-                with torch.no_grad():
-                    mirror = trans.functional.hflip(img)
-                    emb = self.model(self.test_transform(img).to(self.conf.device).unsqueeze(0))
-                    emb_mirror = self.model(self.test_transform(mirror).to(self.conf.device).unsqueeze(0))
-                    embs.append(l2_norm(emb + emb_mirror))
-            else:
-                with torch.no_grad():                        
-                    embs.append(self.model(self.test_transform(img).to(self.conf.device).unsqueeze(0)))
-        source_embs = torch.cat(embs)
-        diff = source_embs.unsqueeze(-1) - target_embs.transpose(1, 0).unsqueeze(0)
-        dist = torch.sum(torch.pow(diff, 2), dim=1)
-        minimum, min_idx = torch.min(dist, dim=1)
+        source_embs = self.embed_tensor(faces)
+        min_idx, minimum = nearest_tensor(source_embs, target_embs, self.conf.match_row_block, self.conf.match_col_block)
         min_idx[minimum > self.threshold] = -1 # if no match, set idx to -1
         return min_idx, minimum, source_embs
     def infer_numpy(self, faces, target_embs):
         '''
-        faces : list of PIL Image
-        target_embs : [n, 512] computed embeddings of faces in facebank
+        faces : list of PIL Image or a normalized [n, 3, 112, 112] tensor from align_multi(as_tensor=True)
+        target_embs : [n, 512] computed embeddings of faces in facebank or an IVFPQIndex built over them
         names : recorded names of faces in facebank
         tta : test time augmentation (hfilp, that's all)
         '''
-        embs = []
-        for img in faces:
-            if self.tta:
-                with torch.no_grad():
-                    mirror = trans.functional.hflip(img)
-                    emb = self.model(self.test_transform(img).to(self.conf.device).unsqueeze(0))
-                    emb_mirror = self.model(self.test_transform(mirror).to(self.conf.device).unsqueeze(0))
-                    embs.append(l2_norm(emb + emb_mirror).data.cpu().numpy())
-            else:
-                with torch.no_grad():                        
-                    embs.append(self.model(self.test_transform(img).to(self.conf.device).unsqueeze(0)).data.cpu().numpy())
-        source_embs = np.array(embs)
-        diff =  source_embs - np.expand_dims(target_embs, 0)
-        dist = np.sum(np.power(diff, 2), axis=2)
-        minimum = np.amin(dist, axis=1)
-
-        min_idx = np.argmin(dist, axis=1)
-
-        # minimum, min_idx = torch.min(dist, dim=1)
+        embs = self.embed(faces)
+        if isinstance(target_embs, IVFPQIndex):
+            minimum, min_idx = target_embs.search(embs, 1)
+            minimum, min_idx = minimum[:, 0], min_idx[:, 0]
+        else:
+            min_idx, minimum = nearest_numpy(embs, target_embs, self.conf.match_row_block, self.conf.match_col_block)
+        source_embs = np.expand_dims(embs, 1)
         min_idx[minimum > self.threshold] = -1 # if no match, set idx to -1
         return min_idx, minimum, source_embs
     def take_a_pic(self, name):
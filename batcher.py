@@ -0,0 +1,83 @@
+import threading
+import time
+import queue
+from concurrent.futures import Future
+import torch
+from utils.threads import use_torch_threads
+
+class EmbeddingBatcher(object):
+    '''
+    collects aligned faces from every in-flight caller and runs them through
+    the backbone together, each caller gets back a future with its own rows
+    '''
+    def __init__(self, forward, max_batch_size=32, max_wait=0.005, num_threads=0):
+        '''
+        forward : callable mapping a [n, 3, 112, 112] float tensor to [n, 512] embeddings
+        max_batch_size : maximum number of faces in one forward
+        max_wait : seconds the oldest queued face waits for company before the batch runs
+        num_threads : intra-op threads of the batching thread, 0 keeps what it inherits
+        '''
+        self.forward = forward
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.num_threads = num_threads
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, faces):
+        '''
+        faces : [n, 3, 112, 112] tensor, already normalized by conf.test_transform
+        return : concurrent.futures.Future resolved with the [n, 512] embeddings
+        '''
+        future = Future()
+        self._queue.put((faces, future))
+        return future
+
+    def embed(self, faces):
+        return self.submit(faces).result()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        use_torch_threads(self.num_threads)
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is None:
+                break
+            pending = [item]
+            size = len(item[0])
+            deadline = time.time() + self.max_wait
+            while size < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                pending.append(item)
+                size += len(item[0])
+            self._process(pending)
+
+    def _process(self, pending):
+        try:
+            batch = torch.cat([faces for faces, _ in pending])
+            embs = []
+            for start in range(0, len(batch), self.max_batch_size):
+                embs.append(self.forward(batch[start:start + self.max_batch_size]))
+            embs = torch.cat(embs)
+        except Exception as err:
+            for _, future in pending:
+                future.set_exception(err)
+            return
+        offset = 0
+        for faces, future in pending:
+            future.set_result(embs[offset:offset + len(faces)])
+            offset += len(faces)
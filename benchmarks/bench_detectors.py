@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+runs every detector through detect_align over a folder of images and reports
+latency percentiles, images/s and faces/s, then how well each pair of detectors
+agrees on the boxes (share of faces matched at --iou and their mean iou).
+
+python benchmarks/bench_detectors.py --images mtcnn_pytorch/images --detectors mtcnn face_alignt
+'''
+import os,sys,inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir)
+import argparse
+import itertools
+import time
+from pathlib import Path
+import numpy as np
+import torch
+from PIL import Image
+from utils.detection import match_boxes
+
+IMAGE_SUFFIXES = ['.jpg', '.jpeg', '.png', '.bmp']
+
+def load_detector(name):
+    if name == 'mtcnn':
+        from mtcnn import MTCNN
+        return MTCNN()
+    from align_v2 import Face_Alignt
+    return Face_Alignt(use_gpu = torch.cuda.is_available())
+
+def load_images(folder, limit=None):
+    files = sorted(file for file in Path(folder).rglob('*') if file.suffix.lower() in IMAGE_SUFFIXES)
+    if limit:
+        files = files[:limit]
+    return [(file.name, Image.open(str(file)).convert('RGB')) for file in files]
+
+def run(detector, images, min_face_size, repeat, warmup):
+    '''
+    return : per image latencies in seconds (best of repeat) and the Detections of the last run
+    '''
+    for _, img in images[:warmup]:
+        detector.detect_align(img, min_face_size=min_face_size)
+    latencies, detections = [], []
+    for _, img in images:
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            result = detector.detect_align(img, min_face_size=min_face_size)
+            seconds = time.time() - start
+            best = seconds if best is None else min(best, seconds)
+        latencies.append(best)
+        detections.append(result)
+    return np.array(latencies), detections
+
+def agreement(dets_a, dets_b, iou):
+    matched, total_a, total_b, ious = 0, 0, 0, []
+    for a, b in zip(dets_a, dets_b):
+        pairs = match_boxes(a.boxes, b.boxes, iou)
+        matched += len(pairs)
+        total_a += len(a.boxes)
+        total_b += len(b.boxes)
+        ious.extend(p[2] for p in pairs)
+    return matched, total_a, total_b, (np.mean(ious) if len(ious) > 0 else float('nan'))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='face detector benchmark')
+    parser.add_argument('--images', default='mtcnn_pytorch/images', help='folder of test images, searched recursively')
+    parser.add_argument('--detectors', nargs='+', default=['mtcnn', 'face_alignt'], choices=['mtcnn', 'face_alignt'])
+    parser.add_argument('--min_face_size', type=float, default=30.0)
+    parser.add_argument('--limit', type=int, default=0, help='only the first n images')
+    parser.add_argument('--repeat', type=int, default=1, help='timed runs per image, the best is kept')
+    parser.add_argument('--warmup', type=int, default=2, help='untimed images per detector first')
+    parser.add_argument('--iou', type=float, default=0.5, help='iou for two boxes to be the same face')
+    parser.add_argument('--threads', type=int, default=0, help='torch intra-op threads, 0 keeps the default')
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    images = load_images(args.images, args.limit)
+    assert len(images) > 0, 'no images in %s'%args.images
+    pixels = np.mean([img.size[0] * img.size[1] for _, img in images])
+    print('%d images, %.2f Mpixel on average, %d torch threads'%(len(images), pixels / 1e6, torch.get_num_threads()))
+
+    results = {}
+    print('%-12s %8s %8s %8s %8s %8s %9s %8s'%('detector', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'img/s', 'faces/s', 'faces'))
+    for name in args.detectors:
+        latencies, detections = run(load_detector(name), images, args.min_face_size, args.repeat, args.warmup)
+        results[name] = detections
+        faces = sum(len(d.boxes) for d in detections)
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1000
+        print('%-12s %8.1f %8.1f %8.1f %8.1f %8.2f %9.2f %8d'%(name, p50, p90, p99, latencies.max() * 1000,
+              len(latencies) / latencies.sum(), faces / latencies.sum(), faces))
+
+    for name_a, name_b in itertools.combinations(args.detectors, 2):
+        matched, total_a, total_b, mean_iou = agreement(results[name_a], results[name_b], args.iou)
+        print('%s vs %s: %d matched at iou >= %.2f, %.1f%% of %d %s faces, %.1f%% of %d %s faces, mean iou %.3f'%(
+            name_a, name_b, matched, args.iou, 100.0 * matched / max(total_a, 1), total_a, name_a,
+            100.0 * matched / max(total_b, 1), total_b, name_b, mean_iou))
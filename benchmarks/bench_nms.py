@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+micro-benchmark of utils.nms against the loop implementations it replaced
+(box_utils.nms for MTCNN and the torch nms of align_v2), on random face-like
+boxes. every run also checks that the kept indices are identical.
+
+python benchmarks/bench_nms.py --sizes 50 200 1000 5000
+'''
+import os,sys,inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir)
+import argparse
+import timeit
+import numpy as np
+import torch
+from utils.nms import nms, batched_nms, nms_tensor
+
+def legacy_nms(boxes, overlap_threshold=0.5, mode='union'):
+    # mtcnn_pytorch/src/box_utils.nms before utils.nms
+    if len(boxes) == 0:
+        return []
+    x1, y1, x2, y2, scores = [boxes[:, i] for i in range(5)]
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    order = scores.argsort()[::-1]
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+        xx1 = np.maximum(x1[i], x1[order[1:]])
+        yy1 = np.maximum(y1[i], y1[order[1:]])
+        xx2 = np.minimum(x2[i], x2[order[1:]])
+        yy2 = np.minimum(y2[i], y2[order[1:]])
+        inter = np.maximum(0.0, xx2 - xx1 + 1) * np.maximum(0.0, yy2 - yy1 + 1)
+        if mode == 'min':
+            ovr = inter / np.minimum(areas[i], areas[order[1:]])
+        else:
+            ovr = inter / (areas[i] + areas[order[1:]] - inter)
+        order = order[np.where(ovr <= overlap_threshold)[0] + 1]
+    return keep
+
+def legacy_nms_tensor(bboxes, scores, threshold=0.35):
+    # align_v2.nms before utils.nms
+    x1, y1, x2, y2 = bboxes[:, 0], bboxes[:, 1], bboxes[:, 2], bboxes[:, 3]
+    areas = (x2 - x1) * (y2 - y1)
+    _, order = scores.sort(0, descending=True)
+    keep = []
+    while order.numel() > 0:
+        i = order.item() if order.numel() == 1 else order[0].item()
+        keep.append(i)
+        if order.numel() == 1:
+            break
+        xx1 = x1[order[1:]].clamp(min=x1[i])
+        yy1 = y1[order[1:]].clamp(min=y1[i])
+        xx2 = x2[order[1:]].clamp(max=x2[i])
+        yy2 = y2[order[1:]].clamp(max=y2[i])
+        inter = (xx2 - xx1).clamp(min=0) * (yy2 - yy1).clamp(min=0)
+        ovr = inter / (areas[i] + areas[order[1:]] - inter)
+        ids = (ovr <= threshold).nonzero().squeeze()
+        if ids.numel() == 0:
+            break
+        order = order[ids + 1]
+    return torch.LongTensor(keep)
+
+def random_boxes(n, size=1280, faces=20, seed=0):
+    # clusters of jittered boxes around a few faces, like detector candidates
+    rng = np.random.RandomState(seed)
+    centers = rng.uniform(0, size, (faces, 2))
+    sides = rng.uniform(24, 200, faces)
+    which = rng.randint(0, faces, n)
+    side = sides[which] * rng.uniform(0.8, 1.2, n)
+    c = centers[which] + rng.normal(0, 0.15, (n, 2)) * side[:, None]
+    boxes = np.stack([c[:, 0] - side/2, c[:, 1] - side/2, c[:, 0] + side/2, c[:, 1] + side/2], 1)
+    return np.concatenate([np.round(boxes), rng.uniform(0, 1, (n, 1))], 1)
+
+def bench(fn, repeat):
+    return min(timeit.repeat(fn, number=1, repeat=repeat)) * 1000
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='nms micro-benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 200, 1000, 5000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    print('%8s %6s %12s %12s %8s %6s'%('boxes', 'mode', 'legacy ms', 'shared ms', 'speedup', 'same'))
+    for n in args.sizes:
+        boxes = random_boxes(n)
+        for mode in ['union', 'min']:
+            ref, new = legacy_nms(boxes, 0.5, mode), nms(boxes, 0.5, mode)
+            t_ref = bench(lambda: legacy_nms(boxes, 0.5, mode), args.repeat)
+            t_new = bench(lambda: nms(boxes, 0.5, mode), args.repeat)
+            print('%8d %6s %12.3f %12.3f %7.1fx %6s'%(n, mode, t_ref, t_new, t_ref / t_new, list(ref) == list(new)))
+        bboxes, scores = torch.from_numpy(boxes[:, :4]).float(), torch.from_numpy(boxes[:, 4]).float()
+        ref, new = legacy_nms_tensor(bboxes, scores), nms_tensor(bboxes, scores)
+        t_ref = bench(lambda: legacy_nms_tensor(bboxes, scores), args.repeat)
+        t_new = bench(lambda: nms_tensor(bboxes, scores), args.repeat)
+        print('%8d %6s %12.3f %12.3f %7.1fx %6s'%(n, 'torch', t_ref, t_new, t_ref / t_new, ref.tolist() == new.tolist()))
+        # per-scale nms of a 10 level pyramid: one loop call per scale vs one batched call
+        groups = np.arange(n) % 10
+        per_scale = lambda: [legacy_nms(boxes[groups == g], 0.5) for g in range(10)]
+        ref = sorted(np.concatenate([np.where(groups == g)[0][legacy_nms(boxes[groups == g], 0.5)] for g in range(10)]).tolist())
+        new = sorted(batched_nms(boxes, groups, 0.5).tolist())
+        t_ref = bench(per_scale, args.repeat)
+        t_new = bench(lambda: batched_nms(boxes, groups, 0.5), args.repeat)
+        print('%8d %6s %12.3f %12.3f %7.1fx %6s'%(n, 'batch', t_ref, t_new, t_ref / t_new, ref == new))
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''
+micro-benchmark of the Face_Alignt ONet crop assembly: the per-box loop that
+detect used to run against gather_crops, on the 32..512 pyramid
+of a random image with many kept boxes. every run also checks the batches match.
+
+python benchmarks/bench_onet_crops.py --faces 1 10 50 200
+'''
+import os,sys,inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir)
+import argparse
+import timeit
+import numpy as np
+import torch
+import cv2
+from align_v2 import PYRAMID_SIZES, get_anchors, gather_crops
+
+def legacy_crops(img_pyramid, t_crops, t_which):
+    # Face_Alignt.detect before gather_crops
+    crop_imgs = []
+    for i in range(t_crops.shape[0]):
+        img = img_pyramid[t_which[i]]
+        crop = t_crops[i].numpy()
+        _,h_,w_ = img.shape
+        o_x1,o_y1,o_x2,o_y2 = max(crop[0],0),max(crop[1],0),min(crop[2],w_),min(crop[3],h_)
+        c_x1 = 0 if crop[0] >=0 else -crop[0]
+        c_y1 = 0 if crop[1] >=0 else -crop[1]
+        c_x2 = 64 if crop[2] <= w_ else 64 - (crop[2] - w_)
+        c_y2 = 64 if crop[3] <= h_ else 64 - (crop[3] - h_)
+        crop_img = np.ones((3,64,64))*128
+        np.copyto(crop_img[:,c_y1:c_y2,c_x1:c_x2],img[:,o_y1:o_y2,o_x1:o_x2])
+        crop_imgs.append(crop_img)
+    return torch.from_numpy(np.array(crop_imgs)).float()
+
+def vectorized_crops(img_pyramid, t_crops, t_which):
+    return torch.from_numpy(gather_crops(img_pyramid, t_crops.numpy(), t_which.numpy()))
+
+def bench(fn, repeat):
+    return min(timeit.repeat(fn, number=1, repeat=repeat)) * 1000
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Face_Alignt ONet crop assembly benchmark')
+    parser.add_argument('--faces', type=int, nargs='+', default=[1, 10, 50, 200])
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+    rng = np.random.RandomState(0)
+    img = rng.randint(0, 256, (1024, 1024, 3)).astype(np.uint8)
+    img_pyramid = [cv2.resize(img, (s, s)) for s in PYRAMID_SIZES]
+    chw_pyramid = [level.transpose(2, 0, 1) for level in img_pyramid]
+    crops = torch.cat([get_anchors(s)[1] for s in PYRAMID_SIZES])
+    which = torch.cat([torch.full((len(get_anchors(s)[1]),), level, dtype=torch.long) for level, s in enumerate(PYRAMID_SIZES)])
+    print('%8s %12s %12s %8s %6s'%('faces', 'loop ms', 'gather ms', 'speedup', 'same'))
+    for n in args.faces:
+        # kept boxes are drawn from every level, border anchors included
+        keep = torch.from_numpy(rng.choice(len(crops), n, replace=False))
+        t_crops, t_which = crops[keep], which[keep]
+        same = torch.equal(legacy_crops(chw_pyramid, t_crops, t_which), vectorized_crops(img_pyramid, t_crops, t_which))
+        t_loop = bench(lambda: legacy_crops(chw_pyramid, t_crops, t_which), args.repeat)
+        t_gather = bench(lambda: vectorized_crops(img_pyramid, t_crops, t_which), args.repeat)
+        print('%8d %12.3f %12.3f %7.1fx %6s'%(n, t_loop, t_gather, t_loop / t_gather, same))
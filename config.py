@@ -10,6 +10,7 @@ def get_config(mode = 'app', net_size = 'large', net_mode = 'ir_se', use_mtcnn =
     conf = edict()
     conf.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
     conf.input_size = [112, 112]
+    conf.embedding_size = 512
     conf.face_limit = 5 
     conf.min_face_size = 30 
     if mode =='app':
@@ -23,6 +24,59 @@ def get_config(mode = 'app', net_size = 'large', net_mode = 'ir_se', use_mtcnn =
         conf.facebank_path = '%s/Face_bank'%conf.data_path
         
         conf.threshold = threshold
+        # cross-request micro-batching of embeddings (batcher.EmbeddingBatcher)
+        conf.embed_batch_size = 32
+        conf.embed_max_wait = 0.005 # seconds
+        # facebank matching runs in [row_block, col_block] distance tiles (utils.matching)
+        conf.match_row_block = 1024
+        conf.match_col_block = 16384
+        # IVF-PQ index for large facebanks (utils.ivfpq), pq_m bytes per stored embedding
+        conf.pq_nlist = 256
+        conf.pq_m = 64
+        conf.pq_nbits = 8
+        conf.pq_nprobe = 16
+        conf.pq_index_path = '%s/facebank_ivfpq.npz'%conf.facebank_path
+        # >0: decode and align facebank images in that many processes (utils.facebank.FacebankBuilder)
+        conf.facebank_workers = 0
+        # 'fbk': also write Face_bank/facebank.fbk and serve it memory mapped (utils.facebank_store)
+        conf.facebank_format = 'pth'
+        conf.facebank_dtype = 'float16'
+        # zip jobs detect detect_batch_size images per MTCNN.detect_faces_batch call,
+        # P-Net runs on groups of similar sized images up to detect_batch_pixels input pixels
+        conf.detect_batch_size = 16
+        conf.detect_batch_pixels = 2*1024*1024
+        # larger images are detected on a proxy downscaled to this longest side and the
+        # crops are cut from the full image (utils.detection.detection_proxy), 0 disables
+        conf.detect_max_side = 1024
+        # video face tracking (utils.tracking.FaceTracker): a track is embedded when it starts,
+        # every track_embed_interval frames and when its face quality grows by track_quality_gain
+        conf.track_iou = 0.3
+        conf.track_landmark = 0.35
+        conf.track_max_missed = 5
+        conf.track_embed_interval = 30
+        conf.track_quality_gain = 0.2
+        # a track matches the quality weighted mean of its last track_buffer embeddings against
+        # the track_topk nearest facebank entries, and takes an answer once track_stable matches
+        # in a row gave it with a distance margin of track_margin to the next name (or the threshold)
+        conf.track_buffer = 8
+        conf.track_topk = 5
+        conf.track_margin = 0.1
+        conf.track_stable = 2
+        # detect every detect_interval frames or when the frame moved by more than motion_threshold
+        # (utils.tracking.DetectionScheduler), tracks are extrapolated in between; 1 detects every frame
+        conf.detect_interval = 1
+        conf.motion_threshold = 8.0
+        # threading policy (utils.threads), 0 picks a share of the cores
+        # >0: detection runs on detect_workers threads with detect_threads intra-op threads each
+        conf.detect_workers = 0
+        conf.detect_threads = 0
+        # intra-op threads of the EmbeddingBatcher thread
+        conf.embed_threads = 0
+        # intra-op threads of every thread calling face_recognize, 0 splits the cores over
+        # max_callers, the expected number of concurrent callers (request threads, video workers)
+        conf.caller_threads = 0
+        conf.max_callers = 4
+        conf.cv2_threads = 1
         if use_mtcnn:
             conf.use_mtcnn = True
         else:
@@ -1,7 +1,9 @@
 from flask import Flask, jsonify, make_response, request, abort, redirect
 import logging
+import threading
 from processer import process
 from processer import process_two_image
+from processer import load_recognizer, is_ready
 
 app = Flask(__name__)
 
@@ -9,6 +11,12 @@ app = Flask(__name__)
 def index():
     return redirect("http://tradersupport.club", code=302)
 
+@app.route('/ready')
+def ready():
+    if is_ready():
+        return make_response(jsonify({'ready': True}), 200)
+    return make_response(jsonify({'ready': False}), 503)
+
 @app.route('/face_recognition', methods=['POST'])
 def face_recognition():
     try:
@@ -38,4 +46,7 @@ def not_found(error):
     return make_response(jsonify({'error': 'Resource no found.'}), 404)
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=8084)
\ No newline at end of file
+    # weights, detector and warm-up are loaded once in the background, /ready flips when done
+    threading.Thread(target=load_recognizer, daemon=True).start()
+    # the reloader would fork a second process holding another copy of the model
+    app.run(debug=True, use_reloader=False, threaded=True, host='0.0.0.0', port=8084)
\ No newline at end of file
@@ -4,13 +4,20 @@ from PIL import Image
 from torch.autograd import Variable
 from mtcnn_pytorch.src.get_nets import PNet, RNet, ONet
 # from mtcnn_pytorch.src.model import  ONet
-from mtcnn_pytorch.src.box_utils import nms, calibrate_box, get_image_boxes, convert_to_square
-from mtcnn_pytorch.src.first_stage import run_first_stage
-from mtcnn_pytorch.src.align_trans import get_reference_facial_points, warp_and_crop_face
+from mtcnn_pytorch.src.box_utils import calibrate_box, get_image_boxes, convert_to_square, to_rgb_array
+from mtcnn_pytorch.src.first_stage import run_first_stage_batch
+from utils.nms import batched_nms
+from utils.detection import make_detections, source_scale
+from mtcnn_pytorch.src.align_trans import get_reference_facial_points, similarity_transforms, warp_faces, align_faces
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 # device = 'cpu'
 import time
 class MTCNN():
+    # what detect_align uses for None
+    default_min_face_size = 30.0
+    default_thresholds = [0.3, 0.6, 0.8]
+    default_nms_thresholds = [0.6, 0.6, 0.6]
+
     def __init__(self):
         self.pnet = PNet().to(device)
         self.rnet = RNet().to(device)
@@ -21,41 +28,97 @@ class MTCNN():
         self.refrence = get_reference_facial_points(default_square= True)
         
     def align(self, img):
-        _, landmarks = self.detect_faces(img)
-        facial5points = [[landmarks[0][j],landmarks[0][j+5]] for j in range(5)]
-        warped_face = warp_and_crop_face(np.array(img), facial5points, self.refrence, crop_size=(112,112))
-        return Image.fromarray(warped_face)
+        boxes, landmarks = self.detect_faces(img)
+        _, faces = self._crop_faces(img, boxes, landmarks, limit=1)
+        return faces[0]
     
-    def align_multi(self, img, limit=None, min_face_size=30.0, thresholds = [0.3, 0.6, 0.8], nms_thresholds=[0.6, 0.6, 0.6]):
-        boxes, landmarks = self.detect_faces(img, min_face_size, thresholds= thresholds,
-                     nms_thresholds = nms_thresholds)
+    def align_multi(self, img, limit=None, min_face_size=30.0, thresholds = None, nms_thresholds=None, as_tensor=False, source=None):
+        '''
+        as_tensor : return the faces as one [n, 3, 112, 112] tensor normalized like
+                    conf.test_transform instead of a list of PIL Image
+        source : full resolution image img was downscaled from, see utils.detection
+        '''
+        boxes, landmarks = self.detect_faces(img, self._min_face_size(img, source, min_face_size), thresholds= thresholds or self.default_thresholds,
+                     nms_thresholds = nms_thresholds or self.default_nms_thresholds)
+        if source is not None:
+            boxes, landmarks = self._to_source(img, source, boxes, landmarks)
+            img = source
+        return self._crop_faces(img, boxes, landmarks, limit, as_tensor)
+
+    def align_multi_batch(self, imgs, limit=None, min_face_size=30.0, thresholds = None, nms_thresholds=None, max_batch_pixels=2*1024*1024, as_tensor=False, sources=None):
+        '''
+        align_multi for a list of images, detection runs batched over all of them
+        sources : None or, per image, the full resolution image it was downscaled from (or None)
+        return : list with (boxes, faces) per image
+        '''
+        if sources is None:
+            sources = [None] * len(imgs)
+        detections = self.detect_faces_batch(imgs, [self._min_face_size(img, source, min_face_size) for img, source in zip(imgs, sources)],
+                     thresholds= thresholds or self.default_thresholds,
+                     nms_thresholds = nms_thresholds or self.default_nms_thresholds, max_batch_pixels = max_batch_pixels)
+        results = []
+        for img, source, (boxes, landmarks) in zip(imgs, sources, detections):
+            if source is not None:
+                boxes, landmarks = self._to_source(img, source, boxes, landmarks)
+                img = source
+            results.append(self._crop_faces(img, boxes, landmarks, limit, as_tensor))
+        return results
+
+    def detect_align(self, img, limit=None, min_face_size=None, thresholds=None, nms_thresholds=None, as_tensor=False, source=None):
+        '''
+        utils.detection protocol
+        return : Detections with boxes, scores, landmarks and the aligned faces as arrays
+        '''
+        boxes, landmarks = self.detect_faces(img, self._min_face_size(img, source, min_face_size),
+                                             thresholds = thresholds or self.default_thresholds,
+                                             nms_thresholds = nms_thresholds or self.default_nms_thresholds)
+        if source is not None:
+            boxes, landmarks = self._to_source(img, source, boxes, landmarks)
+            img = source
+        return self._detections(img, boxes, landmarks, limit, as_tensor)
+
+    def _min_face_size(self, img, source, min_face_size):
+        min_face_size = min_face_size or self.default_min_face_size
+        if source is None:
+            return min_face_size
+        # in proxy pixels, but not below the 12 pixels P-Net sees natively, that would upsample the proxy again
+        return max(min_face_size / max(source_scale(img, source)), 12.0)
+
+    def _to_source(self, img, source, boxes, landmarks):
+        # boxes and landmarks found on the proxy img, in pixels of source
+        sx, sy = source_scale(img, source)
+        boxes = np.array(boxes, dtype=np.float32).reshape(-1, 5)
+        landmarks = np.array(landmarks, dtype=np.float32).reshape(-1, 10)
+        boxes[:, [0, 2]] *= sx
+        boxes[:, [1, 3]] *= sy
+        landmarks[:, 0:5] *= sx
+        landmarks[:, 5:10] *= sy
+        return boxes, landmarks
+
+    def _detections(self, img, boxes, landmarks, limit=None, as_tensor=False):
+        # every face of the image is aligned in one batch
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 5)
+        landmarks = np.asarray(landmarks).reshape(-1, 10)
         if limit:
             boxes = boxes[:limit]
             landmarks = landmarks[:limit]
-        faces = []
-        faces_2 = []
-        for landmark in landmarks:
-            facial5points = [[landmark[j],landmark[j+5]] for j in range(5)]
-            warped_face = warp_and_crop_face(np.array(img), facial5points, self.refrence, crop_size=(112,112))
-            faces.append(Image.fromarray(warped_face))
-           
-        return boxes, faces
+        facial5points = np.stack([landmarks[:, 0:5], landmarks[:, 5:10]], 2)
+        image_array = to_rgb_array(img)
+        if as_tensor:
+            faces = align_faces(image_array, facial5points, self.refrence, crop_size=(112,112))
+        else:
+            faces = warp_faces(image_array, similarity_transforms(facial5points, self.refrence), crop_size=(112,112))
+        return make_detections(boxes[:, :4], boxes[:, 4], facial5points, faces)
 
-    def detect_faces(self, image, min_face_size=40.0,
-                     thresholds=[0.3, 0.55, 0.8],
-                     nms_thresholds=[0.6, 0.6, 0.6]):
-        """
-        Arguments:
-            image: an instance of PIL.Image.
-            min_face_size: a float number.
-            thresholds: a list of length 3.
-            nms_thresholds: a list of length 3.
-
-        Returns:
-            two float numpy arrays of shapes [n_boxes, 4] and [n_boxes, 10],
-            bounding boxes and facial landmarks.
-        """
+    def _crop_faces(self, img, boxes, landmarks, limit=None, as_tensor=False):
+        if limit:
+            boxes = boxes[:limit]
+        faces = self._detections(img, boxes, landmarks, limit, as_tensor).faces
+        if as_tensor:
+            return boxes, faces
+        return boxes, [Image.fromarray(face) for face in faces]
 
+    def _scales(self, image, min_face_size):
         # BUILD AN IMAGE PYRAMID
         width, height = image.size
         min_length = min(height, width)
@@ -77,46 +140,113 @@ class MTCNN():
             scales.append(m*factor**factor_count)
             min_length *= factor
             factor_count += 1
+        return scales
+
+    def _size_groups(self, images, max_batch_pixels):
+        '''
+        split image indices into groups of similar size for one P-Net forward,
+        a group is padded to its largest image and kept under max_batch_pixels
+        '''
+        order = sorted(range(len(images)), key=lambda i: (images[i].size[1], images[i].size[0]))
+        groups = []
+        for i in order:
+            width, height = images[i].size
+            if len(groups) > 0:
+                group = groups[-1]
+                max_w = max([images[j].size[0] for j in group] + [width])
+                max_h = max([images[j].size[1] for j in group] + [height])
+                # padding to the group size may not cost more than a quarter of the image
+                if max_w * max_h * (len(group) + 1) <= max_batch_pixels and max_w * max_h <= 1.25 * width * height:
+                    group.append(i)
+                    continue
+            groups.append([i])
+        return groups
+
+    def detect_faces(self, image, min_face_size=40.0,
+                     thresholds=[0.3, 0.55, 0.8],
+                     nms_thresholds=[0.6, 0.6, 0.6]):
+        """
+        Arguments:
+            image: an instance of PIL.Image.
+            min_face_size: a float number.
+            thresholds: a list of length 3.
+            nms_thresholds: a list of length 3.
+
+        Returns:
+            two float numpy arrays of shapes [n_boxes, 4] and [n_boxes, 10],
+            bounding boxes and facial landmarks.
+        """
+        return self.detect_faces_batch([image], min_face_size, thresholds, nms_thresholds)[0]
+
+    def detect_faces_batch(self, images, min_face_size=40.0,
+                     thresholds=[0.3, 0.55, 0.8],
+                     nms_thresholds=[0.6, 0.6, 0.6],
+                     max_batch_pixels=2*1024*1024):
+        """
+        Arguments:
+            images: a list of PIL.Image.
+            min_face_size: a float number, or a list with one per image.
+            thresholds: a list of length 3.
+            nms_thresholds: a list of length 3.
+            max_batch_pixels: an integer, input pixels of one P-Net forward.
+
+        Returns:
+            a list with, for every image, the (bounding boxes, landmarks)
+            detect_faces would return for it. P-Net runs once per group of
+            similar sized images, R-Net and O-Net once for the candidates
+            of all images together.
+        """
+        results = [([], []) for _ in images]
+        if len(images) == 0:
+            return results
+        image_arrays = [to_rgb_array(image) for image in images]
+        if not isinstance(min_face_size, (list, tuple)):
+            min_face_size = [min_face_size] * len(images)
+        scales = [self._scales(image, size) for image, size in zip(images, min_face_size)]
 
-        # STAGE 1
-        bounding_boxes = []
         with torch.no_grad():
-            for s in scales:
-                boxes = run_first_stage(image, self.pnet, scale=s, threshold=thresholds[0])
-                bounding_boxes.append(boxes)
-            bounding_boxes = [i for i in bounding_boxes if i is not None]
-            bounding_boxes = np.vstack(bounding_boxes)
-            keep = nms(bounding_boxes[:, 0:5], nms_thresholds[0])
-            bounding_boxes = bounding_boxes[keep]
+            # STAGE 1
+            stage_one = [None] * len(images)
+            for group in self._size_groups(images, max_batch_pixels):
+                boxes = run_first_stage_batch([images[i] for i in group], self.pnet, [scales[i] for i in group], threshold=thresholds[0])
+                for i, b in zip(group, boxes):
+                    stage_one[i] = b
+            # which image every candidate comes from
+            which = np.concatenate([np.full(len(b), i) for i, b in enumerate(stage_one)])
+            bounding_boxes = np.vstack(stage_one)
+            if len(bounding_boxes) == 0:
+                return results
+            keep = batched_nms(bounding_boxes[:, 0:5], which, nms_thresholds[0])
+            bounding_boxes, which = bounding_boxes[keep], which[keep]
             bounding_boxes = calibrate_box(bounding_boxes[:, 0:5], bounding_boxes[:, 5:])
             bounding_boxes = convert_to_square(bounding_boxes)
             bounding_boxes[:, 0:4] = np.round(bounding_boxes[:, 0:4])
             # STAGE 2
-            img_boxes = get_image_boxes(bounding_boxes, image, size=24)
+            img_boxes = self._image_boxes(bounding_boxes, which, image_arrays, size=24)
             img_boxes = torch.FloatTensor(img_boxes).to(device)
             output = self.rnet(img_boxes)
             offsets = output[0].cpu().data.numpy()  # shape [n_boxes, 4]
             probs = output[1].cpu().data.numpy()  # shape [n_boxes, 2]
             keep = np.where(probs[:, 1] > thresholds[1])[0]
-            bounding_boxes = bounding_boxes[keep]
+            bounding_boxes, which = bounding_boxes[keep], which[keep]
             bounding_boxes[:, 4] = probs[keep, 1].reshape((-1,))
             offsets = offsets[keep]
-            keep = nms(bounding_boxes, nms_thresholds[1])
-            bounding_boxes = bounding_boxes[keep]
+            keep = batched_nms(bounding_boxes, which, nms_thresholds[1])
+            bounding_boxes, which = bounding_boxes[keep], which[keep]
             bounding_boxes = calibrate_box(bounding_boxes, offsets[keep])
             bounding_boxes = convert_to_square(bounding_boxes)
             bounding_boxes[:, 0:4] = np.round(bounding_boxes[:, 0:4])
             # STAGE 3
-            img_boxes = get_image_boxes(bounding_boxes, image, size=48)
-            if len(img_boxes) == 0: 
-                return [], []
+            if len(bounding_boxes) == 0:
+                return results
+            img_boxes = self._image_boxes(bounding_boxes, which, image_arrays, size=48)
             img_boxes = torch.FloatTensor(img_boxes).to(device)
             output = self.onet(img_boxes)
             landmarks = output[0].cpu().data.numpy()  # shape [n_boxes, 10]
             offsets = output[1].cpu().data.numpy()  # shape [n_boxes, 4]
             probs = output[2].cpu().data.numpy()  # shape [n_boxes, 2]
             keep = np.where(probs[:, 1] > thresholds[2])[0]
-            bounding_boxes = bounding_boxes[keep]
+            bounding_boxes, which = bounding_boxes[keep], which[keep]
             bounding_boxes[:, 4] = probs[keep, 1].reshape((-1,))
             offsets = offsets[keep]
             landmarks = landmarks[keep]
@@ -126,7 +256,19 @@ class MTCNN():
             landmarks[:, 0:5] = np.expand_dims(xmin, 1) + np.expand_dims(width, 1)*landmarks[:, 0:5]
             landmarks[:, 5:10] = np.expand_dims(ymin, 1) + np.expand_dims(height, 1)*landmarks[:, 5:10]
             bounding_boxes = calibrate_box(bounding_boxes, offsets)
-            keep = nms(bounding_boxes, nms_thresholds[2], mode='min')
-            bounding_boxes = bounding_boxes[keep]
-            landmarks = landmarks[keep]
-        return bounding_boxes, landmarks
+            keep = batched_nms(bounding_boxes, which, nms_thresholds[2], mode='min')
+            bounding_boxes, which, landmarks = bounding_boxes[keep], which[keep], landmarks[keep]
+
+        # split back per image, keep is score ordered so every image keeps its own order
+        for i in np.unique(which):
+            mask = which == i
+            results[i] = (bounding_boxes[mask], landmarks[mask])
+        return results
+
+    def _image_boxes(self, bounding_boxes, which, image_arrays, size):
+        # crops of every image, in the order of bounding_boxes
+        img_boxes = np.zeros((len(bounding_boxes), 3, size, size), 'float32')
+        for i in np.unique(which):
+            mask = which == i
+            img_boxes[mask] = get_image_boxes(bounding_boxes[mask], image_arrays[i], size=size)
+        return img_boxes
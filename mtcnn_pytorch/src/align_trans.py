@@ -5,6 +5,7 @@ Created on Mon Apr 24 15:43:29 2017
 """
 import numpy as np
 import cv2
+import torch
 
 # from scipy.linalg import lstsq
 # from scipy.ndimage import geometric_transform  # , map_coordinates
@@ -296,4 +297,94 @@ def warp_and_crop_face(src_img,
 
     face_img = cv2.warpAffine(src_img, tfm, (crop_size[0], crop_size[1]))
 
-    return face_img
\ No newline at end of file
+    return face_img
+
+def similarity_transforms(src_pts, dst_pts, reflective=True):
+    """
+    Function:
+    ----------
+        closed form least squares similarity transforms of N point sets at
+        once, the batched counterpart of get_similarity_transform_for_cv2:
+        like cp2tform the dst -> src transform is fitted and then inverted
+    Parameters:
+    ----------
+        @src_pts: NxKx2 np.array, (x, y) points of every face
+        @dst_pts: Kx2 or NxKx2 np.array, reference points
+        @reflective: also fit the mirrored transform and keep it where its
+            residual is smaller
+    Returns:
+    ----------
+        @tfms: Nx2x3 np.array, cv2.warpAffine matrices mapping src to dst
+    """
+    src = np.asarray(src_pts, dtype=np.float64)
+    src = src.reshape(-1, src.shape[-2], 2)
+    dst = np.broadcast_to(np.asarray(dst_pts, dtype=np.float64), src.shape)
+
+    def fit(dst):
+        # least squares src = [[a, -b], [b, a]] * dst + t, returned inverted as src -> dst
+        src_mean, dst_mean = src.mean(1), dst.mean(1)
+        d, s = dst - dst_mean[:, None], src - src_mean[:, None]
+        norm = np.sum(d * d, axis=(1, 2))
+        a = np.sum(d * s, axis=(1, 2)) / norm
+        b = np.sum(d[:, :, 0] * s[:, :, 1] - d[:, :, 1] * s[:, :, 0], axis=1) / norm
+        scale = a * a + b * b
+        tfms = np.zeros((len(src), 2, 3))
+        tfms[:, 0, 0], tfms[:, 0, 1], tfms[:, 1, 0], tfms[:, 1, 1] = a / scale, b / scale, -b / scale, a / scale
+        tfms[:, :, 2] = dst_mean - np.einsum('nij,nj->ni', tfms[:, :, :2], src_mean)
+        return tfms
+
+    def residual(tfms):
+        moved = np.einsum('nij,nkj->nki', tfms[:, :, :2], src) + tfms[:, None, :, 2]
+        return np.sum((moved - dst) ** 2, axis=(1, 2))
+
+    tfms = fit(dst)
+    if reflective:
+        # fit against the mirrored reference, then mirror the result back
+        tfms_r = fit(dst * [-1.0, 1.0])
+        tfms_r[:, 0] *= -1
+        better = residual(tfms_r) < residual(tfms)
+        tfms[better] = tfms_r[better]
+    return tfms
+
+
+def warp_faces(src_img, tfms, crop_size=(112, 112)):
+    """
+    Function:
+    ----------
+        warp every face of one image into one preallocated batch
+    Parameters:
+    ----------
+        @src_img: HxWxC uint8 np.array
+        @tfms: Nx2x3 np.array, matrices from similarity_transforms
+        @crop_size: (w, h) output face size
+    Returns:
+    ----------
+        @faces: NxhxwxC uint8 np.array
+    """
+    tfms = np.asarray(tfms, dtype=np.float64).reshape(-1, 2, 3)
+    faces = np.empty((len(tfms), crop_size[1], crop_size[0], src_img.shape[2]), np.uint8)
+    # cv2.warpAffine per crop is faster on cpu than one numpy or grid_sample gather
+    for face, tfm in zip(faces, tfms):
+        cv2.warpAffine(src_img, tfm, crop_size, dst=face)
+    return faces
+
+
+def align_faces(src_img, facial_pts, reference_pts, crop_size=(112, 112)):
+    """
+    Function:
+    ----------
+        align all faces of one image into a batch ready for the backbone
+    Parameters:
+    ----------
+        @src_img: HxWx3 uint8 np.array, RGB
+        @facial_pts: NxKx2 np.array of landmarks
+        @reference_pts: Kx2 np.array, e.g. get_reference_facial_points()
+        @crop_size: (w, h) output face size
+    Returns:
+    ----------
+        @faces: Nx3xhxw float32 torch tensor normalized like conf.test_transform,
+            i.e. (pixel / 255 - 0.5) / 0.5
+    """
+    faces = warp_faces(src_img, similarity_transforms(facial_pts, reference_pts), crop_size)
+    faces = torch.from_numpy(faces).permute(0, 3, 1, 2).float()
+    return faces.sub_(127.5).div_(127.5)
@@ -1,5 +1,7 @@
 import numpy as np
+import cv2
 from PIL import Image
+from utils.nms import nms as shared_nms
 
 
 def nms(boxes, overlap_threshold=0.5, mode='union'):
@@ -12,42 +14,9 @@ def nms(boxes, overlap_threshold=0.5, mode='union'):
         mode: 'union' or 'min'.
 
     Returns:
-        list with indices of the selected boxes
+        int numpy array with indices of the selected boxes
     """
-    # if there are no boxes, return the empty list
-    if len(boxes) == 0:
-        return []
-    x1 = boxes[:, 0]
-    y1 = boxes[:, 1]
-    x2 = boxes[:, 2]
-    y2 = boxes[:, 3]
-    scores = boxes[:, 4]
-
-    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
-    order = scores.argsort()[::-1]
-
-    keep = []
-    while order.size > 0:
-        i = order[0]
-        keep.append(i)
-        xx1 = np.maximum(x1[i], x1[order[1:]])
-        yy1 = np.maximum(y1[i], y1[order[1:]])
-        xx2 = np.minimum(x2[i], x2[order[1:]])
-        yy2 = np.minimum(y2[i], y2[order[1:]])
-
-        w = np.maximum(0.0, xx2 - xx1 + 1)
-        h = np.maximum(0.0, yy2 - yy1 + 1)
-        inter = w * h
-
-        if mode is 'min':
-            ovr = inter / np.minimum(areas[i], areas[order[1:]])
-        else:
-            ovr = inter / (areas[i] + areas[order[1:]] - inter)
-
-        inds = np.where(ovr <= overlap_threshold)[0]
-        order = order[inds + 1]
-
-    return keep
+    return shared_nms(boxes, overlap_threshold, mode)
 
 
 def convert_to_square(bboxes):
@@ -106,12 +75,35 @@ def calibrate_box(bboxes, offsets):
     return bboxes
 
 
+def to_rgb_array(img):
+    """Convert an image to a uint8 RGB array once, so that
+    every stage can cut its boxes out of the same array.
+
+    Arguments:
+        img: an instance of PIL.Image or a uint8 numpy array.
+
+    Returns:
+        a uint8 numpy array of shape [h, w, 3].
+    """
+    img_array = np.asarray(img, 'uint8')
+    if len(img_array.shape) == 2:
+        img_array = cv2.cvtColor(img_array, cv2.COLOR_GRAY2RGB)
+    elif img_array.shape[2] > 3:
+        img_array = img_array[:, :, :3]
+    return img_array
+
+
 def get_image_boxes(bounding_boxes, img, size=24):
     """Cut out boxes from the image.
 
+    All boxes are resampled at once: the image is converted
+    and zero padded a single time and every output pixel is a
+    bilinear blend (cv2.INTER_LINEAR convention) of four
+    gathered source pixels.
+
     Arguments:
         bounding_boxes: a float numpy array of shape [n, 5].
-        img: an instance of PIL.Image.
+        img: an instance of PIL.Image or a uint8 array [h, w, 3].
         size: an integer, size of cutouts.
 
     Returns:
@@ -119,28 +111,39 @@ def get_image_boxes(bounding_boxes, img, size=24):
     """
 
     num_boxes = len(bounding_boxes)
-    width, height = img.size
-
-    [dy, edy, dx, edx, y, ey, x, ex, w, h] = correct_bboxes(bounding_boxes, width, height)
-    img_boxes = np.zeros((num_boxes, 3, size, size), 'float32')
-
-    for i in range(num_boxes):
-        img_box = np.zeros((h[i], w[i], 3), 'uint8')
-
-        img_array = np.asarray(img, 'uint8')
-        if len(img_array.shape) == 2:
-            img_array = cv2.cvtColor(img_array, cv2.COLOR_GRAY2RGB)
-        img_box[dy[i]:(edy[i] + 1), dx[i]:(edx[i] + 1), :] =\
-            img_array[y[i]:(ey[i] + 1), x[i]:(ex[i] + 1), :]
-
-        # resize
-        img_box = Image.fromarray(img_box)
-        img_box = img_box.resize((size, size), Image.BILINEAR)
-        img_box = np.asarray(img_box, 'float32')
-
-        img_boxes[i, :, :, :] = _preprocess(img_box)
-
-    return img_boxes
+    if num_boxes == 0:
+        return np.zeros((0, 3, size, size), 'float32')
+    img_array = to_rgb_array(img)
+    height, width = img_array.shape[:2]
+
+    x1, y1, x2, y2 = [bounding_boxes[:, i].astype('int32') for i in range(4)]
+
+    # one bordered copy big enough for every box,
+    # pixels outside the image are zeros like before
+    pad = int(max(0, -x1.min(), -y1.min(), x2.max() - width + 1, y2.max() - height + 1))
+    if pad > 0:
+        img_array = cv2.copyMakeBorder(img_array, pad, pad, pad, pad, cv2.BORDER_CONSTANT, value=0)
+    x1, y1, x2, y2 = x1 + pad, y1 + pad, x2 + pad, y2 + pad
+
+    # source coordinates of every output pixel, clamped to its box
+    grid = (np.arange(size, dtype='float32') + 0.5)/size
+    xs = x1[:, None] + grid[None, :]*(x2 - x1 + 1)[:, None] - 0.5
+    ys = y1[:, None] + grid[None, :]*(y2 - y1 + 1)[:, None] - 0.5
+    xs = np.clip(xs, x1[:, None], x2[:, None])
+    ys = np.clip(ys, y1[:, None], y2[:, None])
+    x0, y0 = np.floor(xs).astype('int32'), np.floor(ys).astype('int32')
+    xe, ye = np.minimum(x0 + 1, x2[:, None]), np.minimum(y0 + 1, y2[:, None])
+    fx = (xs - x0).astype('float32')[:, None, :, None]
+    fy = (ys - y0).astype('float32')[:, :, None, None]
+
+    # [n, size, size, 3] gathers
+    top = img_array[y0[:, :, None], x0[:, None, :]]*(1.0 - fx) + img_array[y0[:, :, None], xe[:, None, :]]*fx
+    bottom = img_array[ye[:, :, None], x0[:, None, :]]*(1.0 - fx) + img_array[ye[:, :, None], xe[:, None, :]]*fx
+    img_boxes = top*(1.0 - fy) + bottom*fy
+
+    img_boxes = img_boxes.transpose((0, 3, 1, 2))
+    img_boxes = (img_boxes - 127.5)*0.0078125
+    return img_boxes.astype('float32')
 
 
 def correct_bboxes(bboxes, width, height):
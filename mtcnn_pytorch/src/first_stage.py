@@ -1,9 +1,12 @@
 import torch
+import torch.nn.functional as F
 from torch.autograd import Variable
 import math
+import cv2
 from PIL import Image
 import numpy as np
 from .box_utils import nms, _preprocess
+from utils.nms import batched_nms
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 # device = 'cpu'
 
@@ -48,6 +51,191 @@ def run_first_stage(image, net, scale, threshold):
     return boxes[keep]
 
 
+def build_pyramid(image, scales):
+    """Resize the image once per scale, with the same
+    PIL bilinear resampling run_first_stage uses.
+
+    Arguments:
+        image: an instance of PIL.Image.
+        scales: a list of float numbers.
+
+    Returns:
+        a list of uint8 numpy arrays of shape [h, w, 3], one per scale.
+    """
+    width, height = image.size
+    return [np.asarray(image.resize((math.ceil(width*s), math.ceil(height*s)), Image.BILINEAR)) for s in scales]
+
+
+def pack_pyramid(levels, gap=2):
+    """Shelf-pack pyramid levels into one canvas.
+
+    Cutting a level's slice out of the P-Net maps of the canvas
+    gives the maps of that level run on its own only because:
+    - offsets are even, so the 2x2 stride 2 pool cells of a level
+      are the same ones it gets alone and its cells start at
+      (oy//2, ox//2) of the output map;
+    - P-Net has no padding, so a level's output cells only read
+      its own pixels, except for the pool cell on the right (bottom)
+      border of a level of odd width (height). Alone, ceil_mode
+      pools that cell over one conv1 column (row). In the canvas it
+      also holds conv1 column ox+w-2, which reads one pixel past the
+      level. _seal_borders overwrites that column (row) with the
+      last valid one, so the max is unchanged.
+    The next level starts after that column whatever the gap, so
+    the gap is only a margin. Odd offsets, padding or a different
+    pooling in P-Net break this; tests/test_first_stage.py
+    compares the packed and the per-scale boxes.
+
+    Arguments:
+        levels: a list of uint8 numpy arrays [h, w, 3], largest first.
+        gap: an integer, empty pixels between levels.
+
+    Returns:
+        canvas: a float numpy array of shape [1, 3, H, W], preprocessed.
+        offsets: a list of (y, x) integer positions of the levels.
+    """
+    even = lambda v: (v + 1)//2*2
+    canvas_width = even(levels[0].shape[1])
+    offsets = []
+    x, y, row_height = 0, 0, 0
+    for level in levels:
+        h, w = level.shape[:2]
+        if x > 0 and x + w > canvas_width:
+            x, y, row_height = 0, even(y + row_height + gap), 0
+        offsets.append((y, x))
+        x = even(x + w + gap)
+        row_height = max(row_height, h)
+    canvas = np.zeros((1, 3, y + row_height, canvas_width), 'float32')
+    for (oy, ox), level in zip(offsets, levels):
+        h, w = level.shape[:2]
+        canvas[0, :, oy:oy + h, ox:ox + w] = _preprocess(level.astype('float32'))[0]
+    return canvas, offsets
+
+
+def _seal_borders(x, sizes, offsets):
+    """Reproduce ceil_mode pooling at the borders of odd sized
+    levels inside the packed conv1 output (see pack_pyramid).
+
+    Arguments:
+        x: a float tensor of shape [3, H - 2, W - 2], conv1 output
+            of one canvas, changed in place.
+        sizes: a list of (h, w) sizes of the levels.
+        offsets: a list of (y, x) positions of the levels.
+    """
+    for (h, w), (oy, ox) in zip(sizes, offsets):
+        if h < 3 or w < 3:
+            continue
+        # conv1 output of the level is [h - 2, w - 2] at (oy, ox)
+        if (w - 2) % 2 == 1 and ox + w - 2 < x.size(2):
+            x[:, oy:oy + h - 2, ox + w - 2] = x[:, oy:oy + h - 2, ox + w - 3]
+        if (h - 2) % 2 == 1 and oy + h - 2 < x.size(1):
+            x[:, oy + h - 2, ox:ox + w - 1] = x[:, oy + h - 3, ox:ox + w - 1]
+
+
+def _pyramid_boxes(logits, offsets_map, scales, sizes, offsets, threshold):
+    """Cut the P-Net maps of one packed canvas back into
+    pyramid levels and generate their bounding boxes.
+
+    Arguments:
+        logits: a float tensor of shape [1, 2, H', W'].
+        offsets_map: a float tensor of shape [1, 4, H', W'].
+        scales: a list of float numbers.
+        sizes: a list of (h, w) sizes of the levels.
+        offsets: a list of (y, x) positions of the levels.
+        threshold: a float number.
+
+    Returns:
+        a float numpy array of shape [n_boxes, 9],
+            the boxes of all scales after per-scale NMS.
+    """
+    boxes, groups = [], []
+    for i, (s, (h, w), (oy, ox)) in enumerate(zip(scales, sizes, offsets)):
+        out_h, out_w = math.ceil((h - 2)/2) - 4, math.ceil((w - 2)/2) - 4
+        if out_h <= 0 or out_w <= 0:
+            continue
+        cy, cx = oy//2, ox//2
+        # P-Net's forward normalizes over the last axis, do the same inside
+        # each level so the scores match running the scale on its own
+        probs = F.softmax(logits[:, :, cy:cy + out_h, cx:cx + out_w], dim=-1)
+        probs = probs.cpu().data.numpy()[0, 1, :, :]
+        level_offsets = offsets_map[:, :, cy:cy + out_h, cx:cx + out_w].cpu().data.numpy()
+        level_boxes = _generate_bboxes(probs, level_offsets, s, threshold)
+        if len(level_boxes) == 0:
+            continue
+        boxes.append(level_boxes)
+        groups.append(np.full(len(level_boxes), i))
+    if len(boxes) == 0:
+        return np.zeros((0, 9), 'float32')
+    boxes, groups = np.vstack(boxes), np.concatenate(groups)
+
+    # per-scale NMS for all scales at once
+    keep = batched_nms(boxes[:, 0:5], groups, overlap_threshold=0.5)
+    return boxes[keep]
+
+
+def run_first_stage_pyramid(image, net, scales, threshold):
+    """Run P-Net once over all pyramid levels packed into one canvas,
+    then generate bounding boxes and do NMS per scale.
+
+    Arguments:
+        image: an instance of PIL.Image.
+        net: an instance of pytorch's nn.Module, P-Net.
+        scales: a list of float numbers.
+        threshold: a float number.
+
+    Returns:
+        a float numpy array of shape [n_boxes, 9],
+            the boxes of all scales after per-scale NMS.
+    """
+    return run_first_stage_batch([image], net, [scales], threshold)[0]
+
+
+def run_first_stage_batch(images, net, scales, threshold):
+    """Like run_first_stage_pyramid for several images in one forward.
+    The packed canvases are zero padded to a common size,
+    so images of similar size waste little work.
+
+    Arguments:
+        images: a list of PIL.Image.
+        net: an instance of pytorch's nn.Module, P-Net.
+        scales: a list with a list of float numbers per image.
+        threshold: a float number.
+
+    Returns:
+        a list with a float numpy array of shape [n_boxes, 9] per image.
+    """
+    results = [np.zeros((0, 9), 'float32') for _ in images]
+    packed = []
+    for i, (image, image_scales) in enumerate(zip(images, scales)):
+        if len(image_scales) == 0:
+            continue
+        levels = build_pyramid(image.convert('RGB'), image_scales)
+        canvas, offsets = pack_pyramid(levels)
+        packed.append((i, canvas, [level.shape[:2] for level in levels], offsets))
+    if len(packed) == 0:
+        return results
+
+    height = max(canvas.shape[2] for _, canvas, _, _ in packed)
+    width = max(canvas.shape[3] for _, canvas, _, _ in packed)
+    batch = np.zeros((len(packed), 3, height, width), 'float32')
+    for b, (_, canvas, _, _) in enumerate(packed):
+        batch[b, :, :canvas.shape[2], :canvas.shape[3]] = canvas[0]
+
+    with torch.no_grad():
+        layers = list(net.features.children())
+        x = layers[1](layers[0](torch.FloatTensor(batch).to(device)))
+        for b, (_, _, sizes, offsets) in enumerate(packed):
+            _seal_borders(x[b], sizes, offsets)
+        for layer in layers[2:]:
+            x = layer(x)
+        logits = net.conv4_1(x)
+        offsets_map = net.conv4_2(x)
+
+    for b, (i, _, sizes, offsets) in enumerate(packed):
+        results[i] = _pyramid_boxes(logits[b:b + 1], offsets_map[b:b + 1], scales[i], sizes, offsets, threshold)
+    return results
+
+
 def _generate_bboxes(probs, offsets, scale, threshold):
     """Generate bounding boxes at places
     where there is probably a face.
@@ -2,68 +2,101 @@ import cv2
 from PIL import Image
 import torch
 from config import get_config
-import glob
 from tqdm import tqdm
 import pandas as pd
-import uuid
-import subprocess
-import zipfile
-import os
+import threading
+from itertools import islice
+import numpy as np
+from utils.fetch import fetch_url, open_image, iter_zip_images
 
-def download_file_by_url(url, folder_name):
-	file_path = folder_name + '/' + url.split('/')[-1]
-	command = 'wget %s -P %s'%(url, folder_name)
-	subprocess.call(command, shell=True)
-	return file_path
+_recognizer = None
+_recognizer_lock = threading.Lock()
+_recognizer_ready = threading.Event()
 
-def unzip_file(file_zip_path, folder_name):
-	path_folder = folder_name + '/unzip'
-	zip_ref = zipfile.ZipFile(file_zip_path, 'r')
-	zip_ref.extractall(path_folder)
-	zip_ref.close()
-	return path_folder
+def load_recognizer(conf=None):
+    '''
+    build the process-lifetime face_recognize (backbone + detector + config) once,
+    warm it up and flip the readiness flag; later calls return the same instance
+    '''
+    global _recognizer
+    with _recognizer_lock:
+        if _recognizer is None:
+            from api import face_recognize
+            recognizer = face_recognize(conf if conf is not None else get_config())
+            recognizer.enable_batching()
+            recognizer.warm_up()
+            _recognizer = recognizer
+            _recognizer_ready.set()
+    return _recognizer
+
+def get_recognizer():
+    if _recognizer is None:
+        return load_recognizer()
+    return _recognizer
+
+def is_ready():
+    return _recognizer_ready.is_set()
 
 def process(data):
-	folder_name = str(uuid.uuid1())
-	command = 'mkdir %s'%folder_name
-	subprocess.call(command, shell=True)
-	image_path = download_file_by_url(data['image_url'], folder_name)
-	file_zip_path = download_file_by_url(data['file_zip_url'], folder_name)
-	path = unzip_file(file_zip_path, folder_name)
-	results = process_images(image_path=image_path, path=path)
-	command = 'rm -rf %s'%folder_name
-	subprocess.call(command, shell=True)
-	return results
+    with fetch_url(data['image_url']) as buffer:
+        image = open_image(buffer)
+    with fetch_url(data['file_zip_url']) as archive:
+        results = process_images(image=image, images=iter_zip_images(archive))
+    return results
 
-def process_images(image_path='', path=''):
-    from api import face_recognize
-    conf = get_config()
-    face_recognize = face_recognize(conf)
-    face_recognize._raw_load_single_face(image_path)
-    targets = face_recognize.embeddings
-    submiter = [['image','x1','y1','x2','y2','result']]
-    list_file = glob.glob(path + '/*')
-    if os.path.isfile(list_file[0]) == False: 
-    	path = list_file[0]
-    	print(path)
-    for img in tqdm(glob.glob(path + '/*')):
-        temp = [img.split('/')[-1], 0,0,0,0,0]
-        image = Image.open(img)
+def _align_chunk(face_recognize, imgs):
+    '''
+    detect and align a chunk of images in one batch, image by image if the batch fails
+    so one broken image only loses its own faces
+    '''
+    try:
+        return face_recognize.align_multi_batch(imgs, as_tensor=True)
+    except:
+        pass
+    results = []
+    for img in imgs:
         try:
-            bboxes, faces = face_recognize.align_multi(image)
+            results.append(face_recognize.align_multi(img, as_tensor=True))
         except:
-            bboxes = []
-            faces = []
-        if len(bboxes) > 0:
-            bboxes = bboxes[:,:-1] 
-            bboxes = bboxes.astype(int)
-            bboxes = bboxes + [-1,-1,1,1] 
-            results, score = face_recognize.infer(faces, targets)
+            results.append(([], []))
+    return results
 
-            for id,(re, sc) in enumerate(zip(results, score)):
-                if re != -1:
-                    temp = [img.split('/')[-1], bboxes[id][0], bboxes[id][1], bboxes[id][2], bboxes[id][3], 1]
-        submiter.append(temp)
+def process_images(image, images):
+    '''
+    image : PIL Image holding the reference face
+    images : iterable of (file name, PIL Image) to search the reference face in,
+             detected and embedded conf.detect_batch_size images at a time
+    '''
+    face_recognize = get_recognizer()
+    targets, _ = face_recognize._raw_load_single_face(image)
+    submiter = [['image','x1','y1','x2','y2','result']]
+    images = iter(images)
+    progress = tqdm()
+    while True:
+        chunk = list(islice(images, face_recognize.conf.detect_batch_size))
+        if len(chunk) == 0:
+            break
+        aligned = _align_chunk(face_recognize, [img for _, img in chunk])
+        # one embedding pass for the aligned face tensors of the whole chunk
+        matches = []
+        faces = [image_faces for _, image_faces in aligned if len(image_faces) > 0]
+        if len(faces) > 0:
+            matches, _, _ = face_recognize.infer(torch.cat(faces), targets)
+        start = 0
+        for (name, _), (bboxes, image_faces) in zip(chunk, aligned):
+            temp = [name, 0,0,0,0,0]
+            results = matches[start:start + len(image_faces)] if len(image_faces) > 0 else []
+            start += len(image_faces)
+            if len(bboxes) > 0:
+                bboxes = np.asarray(bboxes)[:,:-1]
+                bboxes = bboxes.astype(int)
+                bboxes = bboxes + [-1,-1,1,1]
+                for id, re in enumerate(results):
+                    if re != -1:
+                        temp = [name, bboxes[id][0], bboxes[id][1], bboxes[id][2], bboxes[id][3], 1]
+            submiter.append(temp)
+        progress.update(len(chunk))
+    progress.close()
     df = pd.DataFrame.from_records(submiter)
     headers = df.iloc[0]
     df = pd.DataFrame(df.values[1:], columns=headers)
@@ -72,18 +105,13 @@ def process_images(image_path='', path=''):
     return results
 
 def process_two_image(data):
-    folder_name = str(uuid.uuid1())
-    command = 'mkdir %s'%folder_name
-    subprocess.call(command, shell=True)
-    image_path_origin = download_file_by_url(data['image_url_origin'], folder_name)
-    image_path_detection = download_file_by_url(data['image_url_detection'], folder_name)
+    with fetch_url(data['image_url_origin']) as buffer:
+        image_origin = open_image(buffer)
+    with fetch_url(data['image_url_detection']) as buffer:
+        image = open_image(buffer)
 
-    from api import face_recognize
-    conf = get_config()
-    face_recognize = face_recognize(conf)
-    face_recognize._raw_load_single_face(image_path_origin)
-    targets = face_recognize.embeddings
-    image = Image.open(image_path_detection)
+    face_recognize = get_recognizer()
+    targets, _ = face_recognize._raw_load_single_face(image_origin)
     submiter = [['image_url','x1','y1','x2','y2','result']]
     try:
         bboxes, faces = face_recognize.align_multi(image)
@@ -94,7 +122,7 @@ def process_two_image(data):
         bboxes = bboxes[:,:-1] 
         bboxes = bboxes.astype(int)
         bboxes = bboxes + [-1,-1,1,1] 
-        results, score = face_recognize.infer(faces, targets)
+        results, score, _ = face_recognize.infer(faces, targets)
 
         for id,(re, sc) in enumerate(zip(results, score)):
             if re != -1:
@@ -107,8 +135,6 @@ def process_two_image(data):
                 }
                 temp = [data['image_url_detection'], bboxes[id][0], bboxes[id][1], bboxes[id][2], bboxes[id][3], 1]
                 submiter.append(temp)
-    command = 'rm -rf %s'%folder_name
-    subprocess.call(command, shell=True)
     df = pd.DataFrame.from_records(submiter)
     headers = df.iloc[0]
     df = pd.DataFrame(df.values[1:], columns=headers)
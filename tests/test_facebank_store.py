@@ -0,0 +1,56 @@
+'''
+utils.facebank_store round trip through the memory mapped file
+
+python -m unittest discover tests
+'''
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import torch
+from utils.facebank_store import save_facebank_file, MappedFacebank, NamesTable
+
+class FacebankStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'facebank.fbk')
+        self.embeddings = np.random.RandomState(0).randn(7, 24).astype(np.float32)
+        self.names = np.array(['Unknown', 'pqh', 'Nguyễn Văn A', 'b', '', 'c d', 'e', 'f'])
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_float32_round_trip(self):
+        save_facebank_file(self.path, torch.from_numpy(self.embeddings), self.names, np.float32)
+        facebank = MappedFacebank(self.path)
+        self.assertEqual(facebank.embeddings.dtype, np.float32)
+        np.testing.assert_array_equal(facebank.embeddings, self.embeddings)
+        self.assertEqual(list(facebank.names), list(self.names))
+
+    def test_float16_round_trip(self):
+        save_facebank_file(self.path, self.embeddings, self.names, np.float16)
+        facebank = MappedFacebank(self.path)
+        np.testing.assert_array_equal(facebank.embeddings, self.embeddings.astype(np.float16))
+
+    def test_names_table(self):
+        save_facebank_file(self.path, self.embeddings, self.names, np.float32)
+        names = MappedFacebank(self.path).names
+        self.assertIsInstance(names, NamesTable)
+        self.assertEqual(len(names), len(self.names))
+        self.assertEqual(names[2], self.names[2])
+        self.assertEqual(names[-1], self.names[-1])
+        idx = np.array([[1, 2], [0, 7]])
+        np.testing.assert_array_equal(names[idx], self.names[idx])
+        np.testing.assert_array_equal(names[1:4], self.names[1:4])
+        with self.assertRaises(IndexError):
+            names[len(self.names)]
+
+    def test_empty_facebank(self):
+        save_facebank_file(self.path, np.zeros(0, dtype=np.float32), ['Unknown'], np.float16, dim=24)
+        facebank = MappedFacebank(self.path)
+        self.assertEqual(facebank.embeddings.shape, (0, 24))
+        self.assertEqual(list(facebank.names), ['Unknown'])
+
+if __name__ == '__main__':
+    unittest.main()
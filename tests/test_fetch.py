@@ -0,0 +1,91 @@
+'''
+utils.fetch against a local http.server on a thread
+
+python -m unittest discover tests
+'''
+import io
+import threading
+import unittest
+import zipfile
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import requests
+from PIL import Image
+from utils.fetch import fetch_url, open_image, iter_zip_images
+
+def _jpeg(size=(32, 24), color=(200, 30, 30)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+def _zip():
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        archive.writestr('people/', b'')
+        archive.writestr('people/a.jpg', _jpeg((16, 16)))
+        archive.writestr('b.jpg', _jpeg((8, 8), (0, 0, 255)))
+        archive.writestr('__MACOSX/people/._a.jpg', b'resource fork')
+        archive.writestr('people/.hidden.jpg', _jpeg())
+        archive.writestr('notes.txt', b'not an image')
+        archive.writestr('broken.jpg', b'\xff\xd8 truncated')
+    return buffer.getvalue()
+
+PAYLOADS = {'/face.jpg': _jpeg(), '/faces.zip': _zip()}
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = PAYLOADS.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class FetchTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), _Handler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.base = 'http://127.0.0.1:%d'%cls.server.server_address[1]
+        # no proxies from the environment for the local server
+        cls.session = requests.Session()
+        cls.session.trust_env = False
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.session.close()
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_fetch_url(self):
+        with fetch_url(self.base + '/face.jpg', session=self.session) as buffer:
+            self.assertEqual(buffer.read(), PAYLOADS['/face.jpg'])
+
+    def test_fetch_url_spills_to_disk(self):
+        with fetch_url(self.base + '/faces.zip', session=self.session, max_memory=64) as buffer:
+            self.assertTrue(buffer._rolled)
+            self.assertEqual(buffer.read(), PAYLOADS['/faces.zip'])
+
+    def test_fetch_url_http_error(self):
+        with self.assertRaises(requests.HTTPError):
+            fetch_url(self.base + '/missing.jpg', session=self.session)
+
+    def test_open_image(self):
+        with fetch_url(self.base + '/face.jpg', session=self.session) as buffer:
+            image = open_image(buffer)
+        self.assertEqual(image.mode, 'RGB')
+        self.assertEqual(image.size, (32, 24))
+
+    def test_iter_zip_images(self):
+        with fetch_url(self.base + '/faces.zip', session=self.session) as archive:
+            images = list(iter_zip_images(archive))
+        self.assertEqual([name for name, _ in images], ['a.jpg', 'b.jpg'])
+        self.assertEqual([image.size for _, image in images], [(16, 16), (8, 8)])
+
+if __name__ == '__main__':
+    unittest.main()
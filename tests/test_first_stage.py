@@ -0,0 +1,59 @@
+'''
+MTCNN stage 1: P-Net over the packed pyramid against one P-Net run per scale
+
+python -m unittest discover tests (from the repository root, for the P-Net weights)
+'''
+import unittest
+import numpy as np
+from PIL import Image
+from mtcnn_pytorch.src.get_nets import PNet
+from mtcnn_pytorch.src.first_stage import run_first_stage, run_first_stage_pyramid, run_first_stage_batch
+
+IMAGES = ['mtcnn_pytorch/images/example.png', 'mtcnn_pytorch/images/jf.jpg',
+          'mtcnn_pytorch/images/face0.jpg', 'PQH_0000.png']
+
+def _scales(image, min_face_size=20.0, factor=0.707):
+    # the pyramid of MTCNN.detect_faces
+    scales = []
+    m = 12.0 / min_face_size
+    min_length = min(image.size) * m
+    while min_length > 12:
+        scales.append(m * factor ** len(scales))
+        min_length *= factor
+    return scales
+
+def _sorted(boxes):
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 9)
+    return boxes[np.lexsort(boxes[:, :5].T)]
+
+class FirstStageTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.pnet = PNet()
+        cls.pnet.eval()
+        cls.images = [Image.open(path).convert('RGB') for path in IMAGES]
+
+    def _per_scale(self, image, scales, threshold):
+        boxes = [run_first_stage(image, self.pnet, s, threshold) for s in scales]
+        boxes = [b for b in boxes if b is not None]
+        return _sorted(np.vstack(boxes) if len(boxes) > 0 else [])
+
+    def test_packed_matches_per_scale(self):
+        # levels of odd and even sizes, so the ceil_mode borders are covered
+        for path, image in zip(IMAGES, self.images):
+            scales = _scales(image)
+            expected = self._per_scale(image, scales, 0.6)
+            packed = _sorted(run_first_stage_pyramid(image, self.pnet, scales, 0.6))
+            self.assertEqual(len(packed), len(expected), path)
+            np.testing.assert_allclose(packed, expected, atol=1e-4, err_msg=path)
+
+    def test_batch_matches_per_scale(self):
+        # canvases of different sizes are zero padded to a common one
+        scales = [_scales(image) for image in self.images]
+        results = run_first_stage_batch(self.images, self.pnet, scales, 0.6)
+        for path, image, image_scales, boxes in zip(IMAGES, self.images, scales, results):
+            expected = self._per_scale(image, image_scales, 0.6)
+            np.testing.assert_allclose(_sorted(boxes), expected, atol=1e-4, err_msg=path)
+
+if __name__ == '__main__':
+    unittest.main()
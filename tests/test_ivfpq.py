@@ -0,0 +1,70 @@
+'''
+utils.ivfpq train / add / search / save / load on tiny galleries
+
+python -m unittest discover tests
+'''
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from utils.ivfpq import IVFPQIndex, kmeans
+
+def _embeddings(n, dim=32, seed=0):
+    x = np.random.RandomState(seed).randn(n, dim).astype(np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+class IVFPQTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _index(self, x, nlist=8, m=4, nbits=4):
+        index = IVFPQIndex(x.shape[1], nlist, m, nbits, nprobe=nlist).train(x, niter=10)
+        index.add(x)
+        return index
+
+    def test_self_matches(self):
+        x = _embeddings(64)
+        index = self._index(x)
+        dist, ids = index.search(x, 3)
+        np.testing.assert_array_equal(ids[:, 0], np.arange(len(x)))
+        self.assertTrue((np.diff(dist, axis=1) >= 0).all())
+
+    def test_shrinks_to_small_gallery(self):
+        # fewer vectors than lists and than 2**nbits codewords
+        x = _embeddings(5)
+        index = self._index(x, nlist=16, nbits=8)
+        self.assertEqual(index.nlist, 5)
+        self.assertEqual(index.ksub, 5)
+        dist, ids = index.search(x, 1)
+        np.testing.assert_array_equal(ids[:, 0], np.arange(len(x)))
+
+    def test_save_load(self):
+        for n in [5, 64]:
+            x = _embeddings(n, seed=n)
+            index = self._index(x, nlist=16, nbits=8)
+            path = os.path.join(self.folder, 'index_%d.npz'%n)
+            index.save(path)
+            loaded = IVFPQIndex.load(path)
+            self.assertEqual((loaded.nlist, loaded.ksub, loaded.ntotal), (index.nlist, index.ksub, index.ntotal))
+            for a, b in zip(index.search(x, 3), loaded.search(x, 3)):
+                np.testing.assert_array_equal(a, b)
+
+    def test_missing_candidates(self):
+        x = _embeddings(4)
+        dist, ids = self._index(x, nlist=2).search(x, 10)
+        self.assertTrue((ids[:, 4:] == -1).all())
+        self.assertTrue(np.isinf(dist[:, 4:]).all())
+
+    def test_kmeans(self):
+        # two well separated blobs end up as the two centroids
+        rng = np.random.RandomState(0)
+        x = np.concatenate([rng.randn(50, 2) * 0.01 + [5, 5], rng.randn(50, 2) * 0.01 - [5, 5]]).astype(np.float32)
+        centroids = kmeans(x, 2)
+        np.testing.assert_allclose(np.sort(centroids[:, 0]), [-5, 5], atol=0.05)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+'''
+utils.matching blocked nearest / top-k search against brute force
+
+python -m unittest discover tests
+'''
+import unittest
+import numpy as np
+import torch
+from utils.matching import nearest_numpy, nearest_tensor, topk_numpy, topk_tensor
+
+def _embeddings(n, dim=16, seed=0):
+    x = np.random.RandomState(seed).randn(n, dim).astype(np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+def _distances(source, target):
+    return ((source[:, None] - target[None]) ** 2).sum(2)
+
+class MatchingTest(unittest.TestCase):
+    def setUp(self):
+        # 37 queries, 53 gallery rows: neither divides by the block sizes below
+        self.source = _embeddings(37, seed=1)
+        self.target = _embeddings(53, seed=2)
+        self.dist = _distances(self.source, self.target)
+        self.blocks = [(1024, 16384), (5, 7), (8, 16), (1, 1)]
+
+    def test_nearest_numpy(self):
+        for row_block, col_block in self.blocks:
+            idx, dist = nearest_numpy(self.source, self.target, row_block, col_block)
+            np.testing.assert_array_equal(idx, self.dist.argmin(1))
+            np.testing.assert_allclose(dist, self.dist.min(1), atol=1e-5)
+
+    def test_nearest_tensor(self):
+        for row_block, col_block in self.blocks:
+            idx, dist = nearest_tensor(torch.from_numpy(self.source), torch.from_numpy(self.target), row_block, col_block)
+            np.testing.assert_array_equal(idx.numpy(), self.dist.argmin(1))
+            np.testing.assert_allclose(dist.numpy(), self.dist.min(1), atol=1e-5)
+
+    def test_topk_numpy(self):
+        order = np.argsort(self.dist, axis=1)[:, :5]
+        for row_block, col_block in self.blocks:
+            idx, dist = topk_numpy(self.source, self.target, 5, row_block, col_block)
+            np.testing.assert_array_equal(idx, order)
+            np.testing.assert_allclose(dist, np.take_along_axis(self.dist, order, 1), atol=1e-5)
+
+    def test_topk_tensor(self):
+        order = np.argsort(self.dist, axis=1)[:, :5]
+        for row_block, col_block in self.blocks:
+            idx, dist = topk_tensor(torch.from_numpy(self.source), torch.from_numpy(self.target), 5, row_block, col_block)
+            np.testing.assert_array_equal(idx.numpy(), order)
+            np.testing.assert_allclose(dist.numpy(), np.take_along_axis(self.dist, order, 1), atol=1e-5)
+
+    def test_topk_larger_than_gallery(self):
+        idx, dist = topk_numpy(self.source, self.target[:3], 5, 8, 2)
+        np.testing.assert_array_equal(idx, np.argsort(self.dist[:, :3], axis=1))
+
+if __name__ == '__main__':
+    unittest.main()
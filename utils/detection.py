@@ -0,0 +1,108 @@
+'''
+common detector protocol. mtcnn.MTCNN and align_v2.Face_Alignt both have
+
+    detect_align(img, limit=None, min_face_size=None, thresholds=None, nms_thresholds=None, as_tensor=False)
+
+returning a Detections of arrays in pixels of the input image, highest score first:
+    boxes      [n, 4] float32 x1, y1, x2, y2
+    scores     [n] float32
+    landmarks  [n, 5, 2] float32 (x, y) of the eyes, the nose and the mouth corners
+    faces      [n, 112, 112, C] uint8 aligned crops in the channel order of the input,
+               or with as_tensor one [n, 3, 112, 112] float tensor normalized like conf.test_transform
+no face gives n = 0, never None. None for min_face_size, thresholds or
+nms_thresholds takes the detector's own defaults, thresholds and
+nms_thresholds are per detector stage so their lengths are detector specific.
+with source=<full resolution image> img is taken as a downscaled proxy of it
+(detection_proxy): the detector runs on img, boxes and landmarks are mapped
+onto source, min_face_size is in source pixels and the faces are cut from source
+'''
+from collections import namedtuple
+import numpy as np
+import torch
+import cv2
+from PIL import Image
+
+Detections = namedtuple('Detections', ['boxes', 'scores', 'landmarks', 'faces'])
+
+def make_detections(boxes, scores, landmarks, faces):
+    return Detections(np.asarray(boxes, dtype=np.float32).reshape(-1, 4),
+                      np.asarray(scores, dtype=np.float32).reshape(-1),
+                      np.asarray(landmarks, dtype=np.float32).reshape(-1, 5, 2),
+                      faces)
+
+def empty_detections(crop_size=(112, 112), channels=3, as_tensor=False):
+    if as_tensor:
+        faces = torch.zeros((0, channels, crop_size[1], crop_size[0]))
+    else:
+        faces = np.zeros((0, crop_size[1], crop_size[0], channels), dtype=np.uint8)
+    return make_detections(np.zeros((0, 4)), np.zeros(0), np.zeros((0, 5, 2)), faces)
+
+def image_size(img):
+    '''
+    return : (width, height) of a PIL Image or an HWC array
+    '''
+    if isinstance(img, Image.Image):
+        return img.size
+    return img.shape[1], img.shape[0]
+
+def detection_proxy(img, max_side):
+    '''
+    img : PIL Image or HWC uint8 array
+    max_side : longest side of the proxy, 0 disables
+    return : img area-downscaled so its longest side is max_side, of the same type,
+             or img itself when it is not larger
+    '''
+    width, height = image_size(img)
+    if max_side <= 0 or max(width, height) <= max_side:
+        return img
+    ratio = float(max_side) / max(width, height)
+    size = (max(1, int(round(width * ratio))), max(1, int(round(height * ratio))))
+    proxy = cv2.resize(np.asarray(img), size, interpolation=cv2.INTER_AREA)
+    if isinstance(img, Image.Image):
+        return Image.fromarray(proxy)
+    return proxy
+
+def source_scale(img, source):
+    '''
+    return : (sx, sy) mapping pixel coordinates of the proxy img onto source
+    '''
+    width, height = image_size(img)
+    source_width, source_height = image_size(source)
+    return float(source_width) / width, float(source_height) / height
+
+def box_iou(boxes_a, boxes_b):
+    '''
+    boxes_a : [n, 4], boxes_b : [m, 4] x1, y1, x2, y2
+    return : [n, m] intersection over union
+    '''
+    a = np.asarray(boxes_a, dtype=np.float64).reshape(-1, 4)[:, None]
+    b = np.asarray(boxes_b, dtype=np.float64).reshape(-1, 4)[None]
+    w = np.maximum(0.0, np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]))
+    h = np.maximum(0.0, np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1]))
+    inter = w * h
+    area_a = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+    area_b = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        iou = inter / (area_a + area_b - inter)
+    return np.nan_to_num(iou)
+
+def match_boxes(boxes_a, boxes_b, threshold=0.5):
+    '''
+    greedy one to one matching, best overlapping pair first
+    return : list of (index in boxes_a, index in boxes_b, iou) with iou >= threshold
+    '''
+    iou = box_iou(boxes_a, boxes_b)
+    pairs = []
+    if iou.size == 0:
+        return pairs
+    used_a, used_b = set(), set()
+    for flat in np.argsort(-iou, axis=None):
+        i, j = np.unravel_index(flat, iou.shape)
+        if iou[i, j] < threshold:
+            break
+        if i in used_a or j in used_b:
+            continue
+        used_a.add(i)
+        used_b.add(j)
+        pairs.append((int(i), int(j), float(iou[i, j])))
+    return pairs
@@ -0,0 +1,298 @@
+'''
+incremental facebank maintenance. a manifest next to facebank.pth records the
+size, mtime and sha1 of every image under conf.facebank_path together with its
+cached embedding, so an update only aligns and embeds added or changed files,
+forgets removed ones and recomputes the means of the identities they touched
+'''
+import hashlib
+import json
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+import torch
+import cv2
+from PIL import Image
+from tqdm import tqdm
+from utils.utils import embed_faces, load_face, save_facebank
+
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_EMBS = 'manifest_embs.npy'
+
+def file_sha1(path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def scan_facebank(root):
+    '''
+    return : {relative path: (identity, os.stat_result)} for every file in root/<identity>/
+    '''
+    files = {}
+    for identity in sorted(Path(root).iterdir()):
+        if not identity.is_dir():
+            continue
+        for file in sorted(identity.iterdir()):
+            if file.is_file():
+                files[file.relative_to(root).as_posix()] = (identity.name, file.stat())
+    return files
+
+class FacebankManifest(object):
+    def __init__(self, root, dim):
+        '''
+        dim : embedding size (conf.embedding_size)
+        '''
+        self.root = Path(root)
+        self.dim = dim
+        self.entries = {}       # relative path -> {'identity', 'size', 'mtime', 'sha1'}
+        self.embeddings = {}    # relative path -> [dim] float32, absent when no face was found
+
+    @classmethod
+    def load(cls, root, dim):
+        manifest = cls(root, dim)
+        path = manifest.root/MANIFEST_NAME
+        if not path.is_file():
+            return manifest
+        with open(str(path)) as f:
+            entries = json.load(f)
+        embs = np.load(str(manifest.root/MANIFEST_EMBS)) if (manifest.root/MANIFEST_EMBS).is_file() else None
+        for rel, entry in entries.items():
+            row = entry.pop('row')
+            if row >= 0:
+                if embs is None:
+                    continue # embeddings lost, treat the file as new
+                manifest.embeddings[rel] = embs[row]
+            manifest.entries[rel] = entry
+        return manifest
+
+    def save(self):
+        entries = {}
+        rows = []
+        for rel, entry in self.entries.items():
+            entry = dict(entry)
+            if rel in self.embeddings:
+                entry['row'] = len(rows)
+                rows.append(self.embeddings[rel])
+            else:
+                entry['row'] = -1
+            entries[rel] = entry
+        embs = np.array(rows, dtype=np.float32).reshape(-1, self.dim)
+        np.save(str(self.root/MANIFEST_EMBS), embs)
+        tmp = self.root/(MANIFEST_NAME + '.tmp')
+        with open(str(tmp), 'w') as f:
+            json.dump(entries, f)
+        os.replace(str(tmp), str(self.root/MANIFEST_NAME))
+
+    def update(self, embed_files):
+        '''
+        embed_files : callable taking a list of absolute paths and returning one
+                      [512] array per path, None where no face could be aligned
+        return : set of identities whose images were added, changed or removed
+        '''
+        files = scan_facebank(self.root)
+        affected = set()
+        for rel in list(self.entries):
+            if rel not in files:
+                affected.add(self.entries.pop(rel)['identity'])
+                self.embeddings.pop(rel, None)
+        todo = []
+        for rel, (identity, stat) in files.items():
+            entry = self.entries.get(rel)
+            if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+                continue
+            sha1 = file_sha1(str(self.root/rel))
+            if entry is not None and entry['sha1'] == sha1:
+                entry['size'], entry['mtime'] = stat.st_size, stat.st_mtime # touched, not changed
+                continue
+            self.entries[rel] = {'identity': identity, 'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': sha1}
+            self.embeddings.pop(rel, None)
+            todo.append(rel)
+            affected.add(identity)
+        if len(todo) > 0:
+            for rel, emb in zip(todo, embed_files([self.root/rel for rel in todo])):
+                if emb is not None:
+                    self.embeddings[rel] = np.asarray(emb, dtype=np.float32)
+        return affected
+
+    def identity_means(self, identities=None):
+        '''
+        identities : only these (a set), None for all
+        return : {identity: mean embedding}, one pass over the manifest; identities without any face are absent
+        '''
+        per_identity = {}
+        for rel, emb in self.embeddings.items():
+            identity = self.entries[rel]['identity']
+            if identities is None or identity in identities:
+                per_identity.setdefault(identity, []).append(emb)
+        return {identity: np.mean(embs, axis=0) for identity, embs in per_identity.items()}
+
+_worker_detector = None
+
+def _init_align_worker(use_mtcnn):
+    # one single-threaded detector per worker process, the pool supplies the parallelism
+    global _worker_detector
+    torch.set_num_threads(1)
+    cv2.setNumThreads(1)
+    if use_mtcnn:
+        from mtcnn import MTCNN
+        _worker_detector = MTCNN()
+    else:
+        from align_v2 import Face_Alignt
+        _worker_detector = Face_Alignt(use_gpu = False)
+
+def _align_worker(file):
+    start = time.time()
+    face = load_face(file, _worker_detector)
+    if face is not None:
+        face = np.asarray(face.convert('RGB'))
+    return face, time.time() - start
+
+class FacebankBuilder(object):
+    '''
+    decodes and aligns facebank images in a process pool while the main process
+    embeds the aligned crops in batches of conf.embed_batch_size
+    '''
+    def __init__(self, conf, model, tta = True, workers = None):
+        self.conf = conf
+        self.model = model
+        self.tta = tta
+        self.workers = workers or multiprocessing.cpu_count()
+        self.stats = {}
+
+    def embed_files(self, files):
+        '''
+        return : list with one [512] float32 array per file, None where no face was found
+        '''
+        files = [str(file) for file in files]
+        results = [None] * len(files)
+        stats = {'images': len(files), 'faces': 0, 'align_seconds': 0.0, 'embed_seconds': 0.0}
+        start = time.time()
+        pending_idx, pending_faces = [], []
+
+        def flush():
+            t = time.time()
+            embs = embed_faces(self.conf, self.model, pending_faces, self.tta).data.cpu().numpy()
+            stats['embed_seconds'] += time.time() - t
+            for i, emb in zip(pending_idx, embs):
+                results[i] = emb
+            stats['faces'] += len(pending_idx)
+            del pending_idx[:], pending_faces[:]
+
+        self.model.eval()
+        ctx = multiprocessing.get_context('spawn')
+        workers = max(1, min(self.workers, len(files)))
+        stats['workers'] = workers
+        # unlike multiprocessing.Pool, a failing initializer raises BrokenProcessPool instead of hanging
+        with ProcessPoolExecutor(workers, mp_context=ctx, initializer=_init_align_worker, initargs=(self.conf.use_mtcnn,)) as pool:
+            aligned = pool.map(_align_worker, files, chunksize=4)
+            for i, (face, seconds) in enumerate(tqdm(aligned, total=len(files), desc='facebank')):
+                stats['align_seconds'] += seconds
+                if face is None:
+                    continue
+                pending_idx.append(i)
+                pending_faces.append(Image.fromarray(face))
+                if len(pending_faces) >= self.conf.embed_batch_size:
+                    flush()
+            if len(pending_faces) > 0:
+                flush()
+        stats['wall_seconds'] = time.time() - start
+        self.stats = stats
+        self.report()
+        return results
+
+    def report(self):
+        stats = self.stats
+        wall = max(stats['wall_seconds'], 1e-6)
+        print('facebank: %d images, %d faces in %.1fs (%.1f images/s) | decode+align %.1f images/s over %d workers | embed %.1f faces/s'%(
+            stats['images'], stats['faces'], wall, stats['images'] / wall,
+            stats['images'] / max(stats['align_seconds'], 1e-6) * stats['workers'], stats['workers'],
+            stats['faces'] / max(stats['embed_seconds'], 1e-6)))
+
+    def build(self):
+        '''
+        full rebuild of facebank.pth / names.npy from conf.facebank_path
+        '''
+        root = self.conf.facebank_path
+        files = scan_facebank(root)
+        rels = list(files)
+        embs = self.embed_files([os.path.join(root, rel) for rel in rels])
+        per_identity = {}
+        for rel, emb in zip(rels, embs):
+            if emb is not None:
+                per_identity.setdefault(files[rel][0], []).append(emb)
+        embeddings = []
+        names = ['Unknown']
+        for identity, identity_embs in per_identity.items():
+            embeddings.append(np.mean(identity_embs, axis=0))
+            names.append(identity)
+        embeddings = np.array(embeddings, dtype=np.float32).reshape(-1, self.conf.embedding_size)
+        names = np.array(names)
+        if self.conf.use_tensor:
+            embeddings = torch.from_numpy(embeddings).to(self.conf.device)
+        save_facebank(self.conf, embeddings, names)
+        return embeddings, names
+
+def embed_image_files(conf, model, mtcnn, files, tta = True):
+    '''
+    align and embed image files conf.embed_batch_size at a time, so only one batch of faces is held in memory
+    return : list with one [512] float32 array per file, None where no face was found
+    '''
+    results = [None] * len(files)
+    for start in range(0, len(files), conf.embed_batch_size):
+        faces = [load_face(file, mtcnn) for file in files[start:start + conf.embed_batch_size]]
+        found = [i for i, face in enumerate(faces) if face is not None]
+        if len(found) > 0:
+            embs = embed_faces(conf, model, [faces[i] for i in found], tta).data.cpu().numpy()
+            for i, emb in zip(found, embs):
+                results[start + i] = emb
+    return results
+
+def update_facebank_incremental(conf, model, mtcnn, tta = True, embed_files = None):
+    '''
+    bring facebank.pth / names.npy up to date with conf.facebank_path, re-embedding
+    only new or changed images; unaffected identities keep their stored mean and order
+    '''
+    model.eval()
+    if embed_files is None:
+        embed_files = lambda files: embed_image_files(conf, model, mtcnn, files, tta)
+    manifest = FacebankManifest.load(conf.facebank_path, conf.embedding_size)
+    affected = manifest.update(embed_files)
+
+    previous = {}
+    try:
+        old_embs = torch.load('%s/facebank.pth'%conf.facebank_path)
+        old_names = np.load('%s/names.npy'%conf.facebank_path)
+        if isinstance(old_embs, torch.Tensor):
+            old_embs = old_embs.data.cpu().numpy()
+        old_embs = np.asarray(old_embs, dtype=np.float32)
+        if len(old_names) == len(old_embs) + 1:
+            previous = {name: emb for name, emb in zip(old_names[1:], old_embs)}
+    except Exception:
+        previous = {}
+
+    # an ordered dict of the identities in manifest order, so membership tests stay O(1)
+    identities = dict.fromkeys(entry['identity'] for entry in manifest.entries.values())
+    order = [name for name in previous if name in identities] + [name for name in identities if name not in previous]
+    recompute = set(name for name in identities if name in affected or name not in previous)
+    means = manifest.identity_means(recompute)
+
+    embeddings = []
+    names = ['Unknown']
+    for identity in order:
+        embedding = means.get(identity) if identity in recompute else previous[identity]
+        if embedding is None:
+            continue
+        embeddings.append(embedding)
+        names.append(identity)
+    manifest.save()
+
+    embeddings = np.array(embeddings, dtype=np.float32).reshape(-1, conf.embedding_size)
+    names = np.array(names)
+    if conf.use_tensor:
+        embeddings = torch.from_numpy(embeddings).to(conf.device)
+    save_facebank(conf, embeddings, names)
+    return embeddings, names
@@ -0,0 +1,131 @@
+'''
+single-file facebank format meant to be memory mapped, so every worker process
+shares one page-cache copy and opening costs the same for any gallery size.
+
+layout (little endian):
+    [0, 64)          header: magic, version, dtype code, rows, dim, names count,
+                     embeddings offset, names offset
+    embeddings       rows x dim float16 or float32, contiguous, 64 byte aligned
+    names table      (names count + 1) uint64 offsets followed by the utf-8 blob,
+                     names[0] is 'Unknown' like names.npy
+
+python -m utils.facebank_store convert Face_bank [--dtype float16]
+turns an existing facebank.pth / names.npy pair into Face_bank/facebank.fbk
+'''
+import argparse
+import os
+import struct
+import numpy as np
+import torch
+
+FACEBANK_FILE = 'facebank.fbk'
+MAGIC = b'FACEBANK'
+VERSION = 1
+HEADER_FMT = '<8sIIQQQQQ'
+HEADER_SIZE = 64
+DTYPES = {1: np.float16, 2: np.float32}
+DTYPE_CODES = {np.dtype(np.float16): 1, np.dtype(np.float32): 2}
+
+def _align(offset, alignment):
+    return (offset + alignment - 1) // alignment * alignment
+
+def save_facebank_file(path, embeddings, names, dtype=np.float16, dim=None):
+    '''
+    embeddings : [n, dim] tensor or array of identity embeddings
+    dim : embedding size, only needed to shape embeddings that are not 2-d (e.g. an empty facebank)
+    names : n + 1 names, names[0] is 'Unknown'
+    the file is written next to path and renamed over it so open maps never see a partial file
+    '''
+    if isinstance(embeddings, torch.Tensor):
+        embeddings = embeddings.data.cpu().numpy()
+    dtype = np.dtype(dtype)
+    embeddings = np.asarray(embeddings)
+    if embeddings.ndim != 2:
+        assert dim is not None or embeddings.size > 0, 'dim of an empty facebank is unknown'
+        embeddings = embeddings.reshape(-1, dim or embeddings.shape[-1])
+    embeddings = np.ascontiguousarray(embeddings, dtype=dtype.newbyteorder('<'))
+    rows, dim = embeddings.shape
+    encoded = [str(name).encode('utf-8') for name in names]
+    offsets = np.cumsum([0] + [len(name) for name in encoded]).astype('<u8')
+    emb_offset = HEADER_SIZE
+    names_offset = _align(emb_offset + embeddings.nbytes, 8)
+    header = struct.pack(HEADER_FMT, MAGIC, VERSION, DTYPE_CODES[dtype], rows, dim, len(encoded), emb_offset, names_offset)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(header.ljust(HEADER_SIZE, b'\0'))
+        f.write(embeddings.tobytes())
+        f.write(b'\0' * (names_offset - emb_offset - embeddings.nbytes))
+        f.write(offsets.tobytes())
+        f.write(b''.join(encoded))
+    os.replace(tmp, path)
+
+class NamesTable(object):
+    '''
+    read-only view of the names table, names are decoded only when indexed;
+    indexing with an int array returns an array of str with the same shape
+    '''
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _name(self, i):
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('name index out of range')
+        return self.blob[int(self.offsets[i]):int(self.offsets[i + 1])].tobytes().decode('utf-8')
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (np.ndarray, list, tuple)):
+            idx = np.asarray(idx)
+            return np.array([self._name(i) for i in idx.ravel()]).reshape(idx.shape)
+        if isinstance(idx, slice):
+            return np.array([self._name(i) for i in range(*idx.indices(len(self)))])
+        return self._name(idx)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._name(i)
+
+class MappedFacebank(object):
+    def __init__(self, path):
+        '''
+        path : facebank.fbk written by save_facebank_file, mapped read-only
+        '''
+        self.path = path
+        self.raw = np.memmap(path, dtype=np.uint8, mode='r')
+        magic, version, code, rows, dim, names_count, emb_offset, names_offset = \
+            struct.unpack(HEADER_FMT, self.raw[:struct.calcsize(HEADER_FMT)].tobytes())
+        assert magic == MAGIC, '%s is not a facebank file'%path
+        assert version == VERSION, 'unsupported facebank version %d'%version
+        dtype = np.dtype(DTYPES[code]).newbyteorder('<')
+        # zero-copy views into the one mapping
+        self.embeddings = self.raw[emb_offset:emb_offset + rows * dim * dtype.itemsize].view(dtype).reshape(rows, dim)
+        offsets = self.raw[names_offset:names_offset + 8 * (names_count + 1)].view('<u8')
+        blob_offset = names_offset + 8 * (names_count + 1)
+        self.names = NamesTable(offsets, self.raw[blob_offset:blob_offset + int(offsets[-1])])
+
+def facebank_file_path(conf):
+    return '%s/%s'%(conf.facebank_path, FACEBANK_FILE)
+
+def convert_facebank(facebank_path, dtype=np.float16):
+    '''
+    write facebank.fbk from the facebank.pth / names.npy pair in facebank_path
+    '''
+    embeddings = torch.load('%s/facebank.pth'%facebank_path)
+    names = np.load('%s/names.npy'%facebank_path)
+    path = '%s/%s'%(facebank_path, FACEBANK_FILE)
+    save_facebank_file(path, embeddings, names, dtype)
+    return path
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='memory mapped facebank files')
+    parser.add_argument('command', choices=['convert'], help='convert facebank.pth / names.npy to facebank.fbk')
+    parser.add_argument('facebank_path', help='folder holding facebank.pth and names.npy')
+    parser.add_argument('--dtype', default='float16', choices=['float16', 'float32'])
+    args = parser.parse_args()
+    print(convert_facebank(args.facebank_path, np.dtype(args.dtype)))
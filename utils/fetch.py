@@ -0,0 +1,81 @@
+'''
+in-memory download helpers used by the flask service: payloads are streamed
+through one pooled http session into a spooled buffer and zip members are
+decoded straight from the archive, nothing is written to the working dir
+'''
+import io
+import tempfile
+import threading
+import zipfile
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image
+
+SPOOL_MAX_SIZE = 32 * 1024 * 1024 # bigger payloads roll over to an anonymous temp file
+CHUNK_SIZE = 64 * 1024
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session(pool_size=16):
+    '''
+    process-wide requests.Session so keep-alive connections are reused across requests
+    '''
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+    return _session
+
+def fetch_url(url, session=None, timeout=30, max_memory=SPOOL_MAX_SIZE):
+    '''
+    url : http(s) url of the payload
+    session : requests.Session, defaults to the shared pooled session
+    return : SpooledTemporaryFile rewound to the start, the caller closes it
+    '''
+    if session is None:
+        session = get_session()
+    buffer = tempfile.SpooledTemporaryFile(max_size=max_memory)
+    try:
+        with session.get(url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(CHUNK_SIZE):
+                buffer.write(chunk)
+    except:
+        buffer.close()
+        raise
+    buffer.seek(0)
+    return buffer
+
+def open_image(fileobj):
+    '''
+    decode a file-like object into an RGB PIL Image
+    '''
+    image = Image.open(fileobj)
+    image.load()
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return image
+
+def iter_zip_images(fileobj):
+    '''
+    fileobj : seekable file-like object holding a zip archive
+    yield : (file name, PIL Image) for every member that decodes as an image,
+            folders inside the archive are flattened
+    '''
+    with zipfile.ZipFile(fileobj) as archive:
+        for info in archive.infolist():
+            if info.filename.endswith('/') or info.filename.startswith('__MACOSX/'):
+                continue
+            name = info.filename.split('/')[-1]
+            if name.startswith('.'):
+                continue
+            try:
+                image = open_image(io.BytesIO(archive.read(info)))
+            except Exception:
+                continue
+            yield name, image
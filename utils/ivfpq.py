@@ -0,0 +1,179 @@
+'''
+IVF-PQ approximate nearest neighbour index for large facebanks, numpy only.
+a coarse k-means quantizer splits the gallery into nlist inverted lists and the
+residual of every embedding to its coarse centroid is product quantized into
+m one-byte codes, so a 512-d float32 row (2KB) is stored in m bytes.
+search visits the nprobe closest lists and scores their codes with per-query
+lookup tables (asymmetric distance), distances are squared l2 like infer
+'''
+import numpy as np
+from utils.matching import nearest_numpy, topk_numpy
+
+def kmeans(x, k, niter=20, seed=0):
+    '''
+    x : [n, d] float32 training vectors, n >= k
+    return : [k, d] float32 centroids
+    '''
+    x = np.asarray(x, dtype=np.float32)
+    assert len(x) >= k, 'kmeans needs at least %d training vectors, got %d'%(k, len(x))
+    rng = np.random.RandomState(seed)
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(niter):
+        assign, _ = nearest_numpy(x, centroids)
+        counts = np.bincount(assign, minlength=k)
+        # per cluster sums with one weighted bincount per dimension, np.add.at is unbuffered and slow
+        sums = np.stack([np.bincount(assign, weights=x[:, j], minlength=k) for j in range(x.shape[1])], axis=1).astype(np.float32)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # re-seed empty clusters on random training points
+        if empty.any():
+            centroids[empty] = x[rng.choice(len(x), int(empty.sum()), replace=False)]
+    return centroids
+
+class IVFPQIndex(object):
+    def __init__(self, dim=512, nlist=256, m=64, nbits=8, nprobe=16):
+        '''
+        dim : embedding size, must be divisible by m
+        nlist : number of coarse centroids / inverted lists
+        m : number of sub-quantizers (bytes per stored vector)
+        nbits : bits per sub-quantizer code, at most 8
+        nlist and the 2**nbits codewords are cut down to the number of training vectors by train
+        nprobe : default number of lists visited by search
+        '''
+        assert dim % m == 0, 'dim must be divisible by m'
+        assert 0 < nbits <= 8, 'codes are stored as uint8'
+        self.dim = dim
+        self.nlist = nlist
+        self.m = m
+        self.nbits = nbits
+        self.ksub = 2 ** nbits
+        self.dsub = dim // m
+        self.nprobe = nprobe
+        self.coarse = None      # [nlist, dim]
+        self.codebooks = None   # [m, ksub, dsub]
+        self.list_ids = [np.zeros(0, dtype=np.int64) for _ in range(nlist)]
+        self.list_codes = [np.zeros((0, m), dtype=np.uint8) for _ in range(nlist)]
+        self.ntotal = 0
+
+    @property
+    def is_trained(self):
+        return self.coarse is not None and self.codebooks is not None
+
+    def train(self, x, niter=20, max_train_points=100000, seed=0):
+        '''
+        x : [n, dim] embeddings used to learn the coarse centroids and the codebooks,
+            a gallery smaller than nlist or 2**nbits gets fewer lists / codewords
+        '''
+        x = np.asarray(x, dtype=np.float32)
+        assert len(x) > 0, 'an IVFPQIndex needs at least one training vector'
+        if len(x) > max_train_points:
+            x = x[np.random.RandomState(seed).choice(len(x), max_train_points, replace=False)]
+        if len(x) < self.nlist:
+            assert self.ntotal == 0, 'can not shrink nlist of an index holding vectors'
+            self.nlist = len(x)
+            self.list_ids = self.list_ids[:self.nlist]
+            self.list_codes = self.list_codes[:self.nlist]
+        self.ksub = min(2 ** self.nbits, len(x))
+        self.coarse = kmeans(x, self.nlist, niter, seed)
+        assign, _ = nearest_numpy(x, self.coarse)
+        residuals = x - self.coarse[assign]
+        self.codebooks = np.stack([kmeans(residuals[:, j*self.dsub:(j + 1)*self.dsub], self.ksub, niter, seed)
+                                   for j in range(self.m)])
+        return self
+
+    def encode(self, residuals):
+        codes = np.zeros((len(residuals), self.m), dtype=np.uint8)
+        for j in range(self.m):
+            codes[:, j], _ = nearest_numpy(residuals[:, j*self.dsub:(j + 1)*self.dsub], self.codebooks[j])
+        return codes
+
+    def add(self, x, ids=None):
+        '''
+        x : [n, dim] embeddings
+        ids : [n] int ids returned by search, defaults to consecutive row numbers
+        '''
+        assert self.is_trained, 'train the index before adding vectors'
+        x = np.asarray(x, dtype=np.float32)
+        if ids is None:
+            ids = np.arange(self.ntotal, self.ntotal + len(x), dtype=np.int64)
+        ids = np.asarray(ids, dtype=np.int64)
+        assign, _ = nearest_numpy(x, self.coarse)
+        codes = self.encode(x - self.coarse[assign])
+        for l in np.unique(assign):
+            rows = assign == l
+            self.list_ids[l] = np.concatenate([self.list_ids[l], ids[rows]])
+            self.list_codes[l] = np.concatenate([self.list_codes[l], codes[rows]])
+        self.ntotal += len(x)
+        return ids
+
+    def _distance_tables(self, residuals):
+        '''
+        residuals : [q, dim] query minus coarse centroid
+        return : [q, m, ksub] squared distances from each query sub-vector to each codeword
+        '''
+        r = residuals.reshape(len(residuals), self.m, self.dsub)
+        tables = np.einsum('qjd,jkd->qjk', r, self.codebooks) * -2
+        tables += np.sum(r * r, axis=2)[:, :, None]
+        tables += np.sum(self.codebooks * self.codebooks, axis=2)[None]
+        return tables
+
+    def search(self, x, k=1, nprobe=None):
+        '''
+        x : [n, dim] query embeddings
+        return : dist [n, k] float32 and ids [n, k] int64 nearest first,
+                 missing candidates are reported as id -1 with distance inf
+        '''
+        assert self.is_trained, 'train the index before searching'
+        x = np.asarray(x, dtype=np.float32).reshape(-1, self.dim)
+        n = len(x)
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        probe, _ = topk_numpy(x, self.coarse, nprobe)
+        cand_dist = [[] for _ in range(n)]
+        cand_ids = [[] for _ in range(n)]
+        for l in np.unique(probe):
+            codes = self.list_codes[l]
+            if len(codes) == 0:
+                continue
+            queries = np.where((probe == l).any(axis=1))[0]
+            tables = self._distance_tables(x[queries] - self.coarse[l])
+            dist = np.zeros((len(queries), len(codes)), dtype=np.float32)
+            for j in range(self.m):
+                dist += tables[:, j, codes[:, j]]
+            for qi, q in enumerate(queries):
+                cand_dist[q].append(dist[qi])
+                cand_ids[q].append(self.list_ids[l])
+        out_dist = np.full((n, k), np.inf, dtype=np.float32)
+        out_ids = np.full((n, k), -1, dtype=np.int64)
+        for q in range(n):
+            if len(cand_dist[q]) == 0:
+                continue
+            d = np.concatenate(cand_dist[q])
+            i = np.concatenate(cand_ids[q])
+            kk = min(k, len(d))
+            top = np.argpartition(d, kk - 1)[:kk]
+            top = top[np.argsort(d[top])]
+            out_dist[q, :kk] = np.maximum(d[top], 0)
+            out_ids[q, :kk] = i[top]
+        return out_dist, out_ids
+
+    def save(self, path):
+        assert self.is_trained, 'nothing to save, the index is not trained'
+        offsets = np.cumsum([0] + [len(ids) for ids in self.list_ids]).astype(np.int64)
+        np.savez(path,
+                 meta=np.array([self.dim, self.nlist, self.m, self.nbits, self.nprobe], dtype=np.int64),
+                 coarse=self.coarse, codebooks=self.codebooks, offsets=offsets,
+                 ids=np.concatenate(self.list_ids), codes=np.concatenate(self.list_codes))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        dim, nlist, m, nbits, nprobe = [int(v) for v in data['meta']]
+        index = cls(dim, nlist, m, nbits, nprobe)
+        index.coarse = data['coarse']
+        index.codebooks = data['codebooks']
+        index.ksub = index.codebooks.shape[1]
+        offsets, ids, codes = data['offsets'], data['ids'], data['codes']
+        index.list_ids = [ids[offsets[l]:offsets[l + 1]] for l in range(nlist)]
+        index.list_codes = [codes[offsets[l]:offsets[l + 1]] for l in range(nlist)]
+        index.ntotal = len(ids)
+        return index
@@ -0,0 +1,123 @@
+'''
+nearest neighbour search of face embeddings against the facebank.
+squared l2 distances come from one matrix multiply per block,
+|s|^2 + |t|^2 - 2 s.t, which is 2 - 2 s.t for l2 normalized rows,
+so no [n, m, 512] difference tensor is ever built
+'''
+import numpy as np
+import torch
+
+ROW_BLOCK = 1024
+COL_BLOCK = 16384
+
+def _col_blocks(target, col_block):
+    for start in range(0, len(target), col_block):
+        yield start, target[start:start + col_block]
+
+def nearest_numpy(source, target, row_block=ROW_BLOCK, col_block=COL_BLOCK):
+    '''
+    source : [n, 512] query embeddings
+    target : [m, 512] facebank embeddings, any float dtype (memmaps are read block by block)
+    return : min_idx [n] int64, minimum [n] float32 squared l2 distance
+    '''
+    source = np.asarray(source, dtype=np.float32).reshape(len(source), -1)
+    n = len(source)
+    minimum = np.full(n, np.inf, dtype=np.float32)
+    min_idx = np.zeros(n, dtype=np.int64)
+    source_sq = np.sum(source * source, axis=1, keepdims=True)
+    for col, tgt in _col_blocks(target, col_block):
+        tgt = np.asarray(tgt, dtype=np.float32)
+        tgt_sq = np.sum(tgt * tgt, axis=1)
+        for row in range(0, n, row_block):
+            src = source[row:row + row_block]
+            dist = source_sq[row:row + row_block] - 2 * np.dot(src, tgt.T) + tgt_sq
+            idx = np.argmin(dist, axis=1)
+            val = dist[np.arange(len(src)), idx]
+            better = val < minimum[row:row + row_block]
+            minimum[row:row + row_block][better] = val[better]
+            min_idx[row:row + row_block][better] = idx[better] + col
+    np.maximum(minimum, 0, out=minimum) # rounding can leave tiny negatives
+    return min_idx, minimum
+
+def nearest_tensor(source, target, row_block=ROW_BLOCK, col_block=COL_BLOCK):
+    '''
+    source : [n, 512] tensor of query embeddings
+    target : [m, 512] tensor of facebank embeddings on the same device
+    return : min_idx [n] LongTensor, minimum [n] squared l2 distance
+    '''
+    n = source.size(0)
+    minimum = source.new_full((n,), float('inf'))
+    min_idx = torch.zeros(n, dtype=torch.long, device=source.device)
+    source_sq = torch.sum(source * source, dim=1, keepdim=True)
+    for col, tgt in _col_blocks(target, col_block):
+        tgt = tgt.to(source.dtype)
+        tgt_sq = torch.sum(tgt * tgt, dim=1).unsqueeze(0)
+        for row in range(0, n, row_block):
+            src = source[row:row + row_block]
+            dist = source_sq[row:row + row_block] - 2 * torch.mm(src, tgt.t()) + tgt_sq
+            val, idx = torch.min(dist, dim=1)
+            better = val < minimum[row:row + row_block]
+            minimum[row:row + row_block][better] = val[better]
+            min_idx[row:row + row_block][better] = idx[better] + col
+    minimum.clamp_(min=0)
+    return min_idx, minimum
+
+def topk_numpy(source, target, k=5, row_block=ROW_BLOCK, col_block=COL_BLOCK):
+    '''
+    source : [n, 512] query embeddings
+    target : [m, 512] facebank embeddings
+    return : topk_idx [n, k] int64, topk_dist [n, k] float32, nearest first;
+             every column block is reduced with argpartition and merged into the running top-k
+    '''
+    source = np.asarray(source, dtype=np.float32).reshape(len(source), -1)
+    n = len(source)
+    k = min(k, len(target))
+    topk_dist = np.full((n, k), np.inf, dtype=np.float32)
+    topk_idx = np.zeros((n, k), dtype=np.int64)
+    source_sq = np.sum(source * source, axis=1, keepdims=True)
+    for col, tgt in _col_blocks(target, col_block):
+        tgt = np.asarray(tgt, dtype=np.float32)
+        tgt_sq = np.sum(tgt * tgt, axis=1)
+        kb = min(k, len(tgt))
+        for row in range(0, n, row_block):
+            src = source[row:row + row_block]
+            rows = np.arange(len(src))[:, None]
+            dist = source_sq[row:row + row_block] - 2 * np.dot(src, tgt.T) + tgt_sq
+            idx = np.argpartition(dist, kb - 1, axis=1)[:, :kb]
+            cand_dist = np.concatenate([topk_dist[row:row + row_block], dist[rows, idx]], axis=1)
+            cand_idx = np.concatenate([topk_idx[row:row + row_block], idx + col], axis=1)
+            keep = np.argpartition(cand_dist, k - 1, axis=1)[:, :k]
+            topk_dist[row:row + row_block] = cand_dist[rows, keep]
+            topk_idx[row:row + row_block] = cand_idx[rows, keep]
+    order = np.argsort(topk_dist, axis=1)
+    rows = np.arange(n)[:, None]
+    topk_dist, topk_idx = topk_dist[rows, order], topk_idx[rows, order]
+    np.maximum(topk_dist, 0, out=topk_dist)
+    return topk_idx, topk_dist
+
+def topk_tensor(source, target, k=5, row_block=ROW_BLOCK, col_block=COL_BLOCK):
+    '''
+    source : [n, 512] tensor of query embeddings
+    target : [m, 512] tensor of facebank embeddings on the same device
+    return : topk_idx [n, k] LongTensor, topk_dist [n, k], nearest first
+    '''
+    n = source.size(0)
+    k = min(k, target.size(0))
+    topk_dist = source.new_full((n, k), float('inf'))
+    topk_idx = torch.zeros((n, k), dtype=torch.long, device=source.device)
+    source_sq = torch.sum(source * source, dim=1, keepdim=True)
+    for col, tgt in _col_blocks(target, col_block):
+        tgt = tgt.to(source.dtype)
+        tgt_sq = torch.sum(tgt * tgt, dim=1).unsqueeze(0)
+        kb = min(k, tgt.size(0))
+        for row in range(0, n, row_block):
+            src = source[row:row + row_block]
+            dist = source_sq[row:row + row_block] - 2 * torch.mm(src, tgt.t()) + tgt_sq
+            val, idx = torch.topk(dist, kb, dim=1, largest=False)
+            cand_dist = torch.cat([topk_dist[row:row + row_block], val], dim=1)
+            cand_idx = torch.cat([topk_idx[row:row + row_block], idx + col], dim=1)
+            val, keep = torch.topk(cand_dist, k, dim=1, largest=False, sorted=True)
+            topk_dist[row:row + row_block] = val
+            topk_idx[row:row + row_block] = torch.gather(cand_idx, 1, keep)
+    topk_dist.clamp_(min=0)
+    return topk_idx, topk_dist
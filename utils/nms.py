@@ -0,0 +1,103 @@
+'''
+greedy non-maximum suppression shared by the MTCNN and Face_Alignt detectors.
+small inputs build the whole overlap matrix in one shot and walk it in score
+order; large inputs sweep the boxes sorted by x1 and only score the candidates
+whose x-range can reach the kept box, so boxes of other scales or images that
+batched_nms shifted apart are never looked at.
+results are identical to the reference loop: highest score first, a box is
+dropped when its overlap with a kept box is above the threshold
+'''
+import numpy as np
+import torch
+
+MATRIX_MAX = 256 # past a few hundred boxes the [n, n] overlap matrix falls out of cache and the sweep wins
+
+def _overlap(x1, y1, x2, y2, areas, i, j, mode, offset):
+    '''
+    overlap of box i with box j, both given as indices or slices into the coordinate
+    arrays (or [:, None] / [None, :] views for a whole matrix)
+    '''
+    w = np.maximum(0.0, np.minimum(x2[i], x2[j]) - np.maximum(x1[i], x1[j]) + offset)
+    h = np.maximum(0.0, np.minimum(y2[i], y2[j]) - np.maximum(y1[i], y1[j]) + offset)
+    inter = w * h
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if mode == 'min':
+            return inter / np.minimum(areas[i], areas[j])
+        return inter / (areas[i] + areas[j] - inter)
+
+def _nms_matrix(x1, y1, x2, y2, areas, order, overlap_threshold, mode, offset):
+    x1, y1, x2, y2, areas = x1[order], y1[order], x2[order], y2[order], areas[order]
+    rows, cols = np.s_[:, None], np.s_[None, :]
+    # suppress[a, b]: a and b (in score order) overlap too much
+    suppress = ~(_overlap(x1, y1, x2, y2, areas, rows, cols, mode, offset) <= overlap_threshold)
+    keep = np.ones(len(order), dtype=bool)
+    for a in range(len(order)):
+        if keep[a]:
+            keep[a + 1:] &= ~suppress[a, a + 1:]
+    return order[keep]
+
+def _nms_sweep(x1, y1, x2, y2, areas, order, overlap_threshold, mode, offset):
+    # boxes are laid out by x1 so everything a kept box can reach is one contiguous window
+    by_x = np.argsort(x1, kind='mergesort')
+    x1, y1, x2, y2, areas = x1[by_x], y1[by_x], x2[by_x], y2[by_x], areas[by_x]
+    position = np.empty_like(by_x)
+    position[by_x] = np.arange(len(by_x))
+    reach = np.max(x2 - x1) + offset
+    lo = np.searchsorted(x1, x1 - reach, 'left')
+    hi = np.searchsorted(x1, x2 + offset, 'right')
+    suppressed = np.zeros(len(x1), dtype=bool)
+    keep = []
+    for i in order:
+        p = position[i]
+        if suppressed[p]:
+            continue
+        keep.append(i)
+        # marking boxes that are already suppressed (or p itself) again is harmless
+        window = slice(lo[p], hi[p])
+        suppressed[window] |= ~(_overlap(x1, y1, x2, y2, areas, p, window, mode, offset) <= overlap_threshold)
+    return np.array(keep, dtype=np.int64)
+
+def nms(boxes, overlap_threshold=0.5, mode='union', scores=None, offset=1):
+    '''
+    boxes : [n, 5] (xmin, ymin, xmax, ymax, score) or [n, 4] with scores given
+    mode : 'union' or 'min'
+    offset : 1 for the inclusive pixel boxes of MTCNN, 0 for continuous coordinates
+    return : int64 array with the indices of the kept boxes, highest score first
+    '''
+    boxes = np.asarray(boxes)
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    if scores is None:
+        scores = boxes[:, 4]
+    x1, y1, x2, y2 = [boxes[:, k] for k in range(4)]
+    areas = (x2 - x1 + offset) * (y2 - y1 + offset)
+    order = np.asarray(scores).argsort()[::-1]
+    if len(order) <= MATRIX_MAX:
+        return _nms_matrix(x1, y1, x2, y2, areas, order, overlap_threshold, mode, offset)
+    return _nms_sweep(x1, y1, x2, y2, areas, order, overlap_threshold, mode, offset)
+
+def batched_nms(boxes, groups, overlap_threshold=0.5, mode='union', scores=None, offset=1):
+    '''
+    nms run independently inside every group (pyramid scale, image, class) in one call
+    groups : [n] int group id of every box
+    return : int64 array of kept indices, highest score first across all groups
+    '''
+    boxes = np.asarray(boxes)
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    groups = np.asarray(groups)
+    # shift every group by more than the coordinate span so groups never overlap
+    coords = boxes[:, :4].astype(np.float64)
+    span = coords.max() - min(coords.min(), 0) + 1 + offset
+    shifted = coords + (groups.astype(np.float64) * span)[:, None]
+    if scores is None:
+        scores = boxes[:, 4]
+    return nms(shifted, overlap_threshold, mode, scores, offset)
+
+def nms_tensor(bboxes, scores, threshold=0.35, mode='union', offset=0):
+    '''
+    bboxes : [n, 4] tensor, scores : [n] tensor
+    return : LongTensor of kept indices, highest score first
+    '''
+    keep = nms(bboxes.detach().cpu().numpy(), threshold, mode, scores.detach().cpu().numpy(), offset)
+    return torch.from_numpy(keep)
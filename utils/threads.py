@@ -0,0 +1,85 @@
+'''
+threading policy of the recognizer. with the OpenMP backend torch keeps the
+intra-op pool size per thread, so every thread that runs torch work pins its
+own count:
+    caller_threads  the callers of face_recognize (flask request threads, the
+                    detection workers of a VideoPipeline, ...) when they detect
+                    or embed on their own thread; by default the cores split
+                    over conf.max_callers concurrent callers, at least 1
+    embed_threads   the single EmbeddingBatcher thread once batching is on; by
+                    default the cores the detection workers leave free
+    detect_threads  the threads of the DetectionExecutor, only with
+                    conf.detect_workers > 0; by default a quarter of the cores
+                    split over the workers
+so with the defaults max_callers concurrent callers together ask for about
+os.cpu_count() intra-op threads instead of that many each. cv2 has one process
+wide pool, kept small so it does not compete with torch for the cores. a 0 in
+conf picks the default
+'''
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import torch
+
+_local = threading.local()
+
+def thread_policy(conf):
+    '''
+    return : dict with the resolved detect_workers, detect_threads, embed_threads, caller_threads and cv2_threads
+    '''
+    cpus = os.cpu_count() or 1
+    workers = max(0, conf.detect_workers)
+    detect_threads = conf.detect_threads
+    if workers > 0 and detect_threads <= 0:
+        detect_threads = max(1, cpus // 4 // workers)
+    embed_threads = conf.embed_threads
+    if embed_threads <= 0:
+        # whatever the detection workers leave free
+        embed_threads = max(1, cpus - workers * detect_threads)
+    caller_threads = conf.caller_threads
+    if caller_threads <= 0:
+        caller_threads = max(1, cpus // max(1, conf.max_callers))
+    return {'detect_workers': workers, 'detect_threads': detect_threads, 'embed_threads': embed_threads,
+            'caller_threads': caller_threads, 'cv2_threads': conf.cv2_threads}
+
+def use_torch_threads(n):
+    '''
+    pin the intra-op pool of the calling thread to n threads, free when it already is.
+    a new thread starts from whatever count was set last anywhere in the process,
+    so threads doing torch work call this before their first op
+    '''
+    if n > 0 and getattr(_local, 'torch_threads', 0) != n:
+        torch.set_num_threads(n)
+        _local.torch_threads = n
+
+def configure_threads(conf):
+    '''
+    apply the cv2 pool size and pin the calling thread, return : thread_policy(conf)
+    '''
+    policy = thread_policy(conf)
+    cv2.setNumThreads(policy['cv2_threads'])
+    use_torch_threads(policy['caller_threads'])
+    return policy
+
+class DetectionExecutor(object):
+    '''
+    runs detector calls on worker threads with their own intra-op pools, so the
+    detection of one request overlaps the embedding of another on a fixed split of the cores
+    '''
+    def __init__(self, workers=1, threads=1):
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix='detect')
+
+    def _call(self, fn, args, kwargs):
+        use_torch_threads(self.threads)
+        return fn(*args, **kwargs)
+
+    def submit(self, fn, *args, **kwargs):
+        return self.pool.submit(self._call, fn, args, kwargs)
+
+    def run(self, fn, *args, **kwargs):
+        return self.submit(fn, *args, **kwargs).result()
+
+    def close(self):
+        self.pool.shutdown()
@@ -0,0 +1,332 @@
+'''
+frame to frame face tracking for video. detections are associated with the
+live tracks by box iou and landmark distance, and a track keeps the identity
+of its last embedding; the backbone only runs for a track when it is new, when
+its embedding is older than embed_interval frames or when the face is seen in
+clearly better quality than when it was embedded.
+tracks move with a constant velocity between detections, so with a
+DetectionScheduler the detector only runs every few frames or on motion and
+FaceTracker.predict carries the boxes over the frames in between.
+identities are decided per track, not per frame: every embedding of a track
+goes into its EmbeddingAccumulator, the quality weighted mean of the last few
+is matched against the facebank and Track.vote only switches the identity once
+the same answer came back with a clear margin several updates in a row
+'''
+import numpy as np
+import cv2
+from utils.detection import box_iou
+
+def face_quality(box, landmarks, score):
+    '''
+    box : [4] x1, y1, x2, y2, landmarks : [5, 2], score : detector score
+    return : score x size term (saturates at the 112 pixel crop) x frontal term
+             (nose centered between the eyes), in [0, 1]
+    '''
+    size = np.sqrt(max(box[2] - box[0], 0) * max(box[3] - box[1], 0))
+    left_eye, right_eye, nose = landmarks[0], landmarks[1], landmarks[2]
+    eye_dist = np.linalg.norm(right_eye - left_eye)
+    if eye_dist <= 0:
+        return 0.0
+    offset = abs(nose[0] - (left_eye[0] + right_eye[0]) / 2.0) / eye_dist
+    return float(score) * min(1.0, size / 112.0) * max(0.0, 1.0 - offset)
+
+def match_margin(topk_idx, topk_names, topk_dist, threshold):
+    '''
+    topk_idx, topk_names, topk_dist : nearest first facebank candidates of one embedding (api.face_recognize.search)
+    return : identity (-1 for nobody), its distance and the margin of that answer, the distance
+             to the nearest other name for a match, how far beyond threshold the nearest is for nobody
+    '''
+    best = float(topk_dist[0])
+    if best > threshold:
+        return -1, best, best - threshold
+    runner = [float(d) for n, d in zip(topk_names[1:], topk_dist[1:]) if n != topk_names[0]]
+    return int(topk_idx[0]), best, (runner[0] if len(runner) > 0 else float('inf')) - best
+
+class EmbeddingAccumulator(object):
+    '''
+    ring buffer of the last size l2 normalized embeddings of a track with their
+    weights (face_quality), mean() is their weighted mean normalized again
+    '''
+    def __init__(self, size=8):
+        self.size = max(1, size)
+        self.embeddings = None
+        self.weights = np.zeros(self.size, dtype=np.float32)
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def add(self, embedding, weight=1.0):
+        embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        embedding = embedding / max(float(np.linalg.norm(embedding)), 1e-12)
+        if self.embeddings is None:
+            self.embeddings = np.zeros((self.size, len(embedding)), dtype=np.float32)
+        slot = self.count % self.size
+        self.embeddings[slot] = embedding
+        # a blurry view still counts a little
+        self.weights[slot] = max(float(weight), 1e-3)
+        self.count += 1
+
+    def mean(self):
+        '''
+        return : [512] float32 unit vector, None while empty
+        '''
+        if self.count == 0:
+            return None
+        n = len(self)
+        mean = np.dot(self.weights[:n], self.embeddings[:n])
+        return mean / max(float(np.linalg.norm(mean)), 1e-12)
+
+class Track(object):
+    def __init__(self, track_id, box, landmarks, score, frame, buffer_size=8):
+        self.id = track_id
+        # box and landmarks are predicted between detections, observed_* hold the last detection
+        self.box = np.asarray(box, dtype=np.float32)
+        self.landmarks = np.asarray(landmarks, dtype=np.float32)
+        self.observed_box = self.box
+        self.observed_landmarks = self.landmarks
+        self.box_velocity = np.zeros(4, dtype=np.float32)
+        self.landmark_velocity = np.zeros((5, 2), dtype=np.float32)
+        self.score = float(score)
+        self.quality = face_quality(self.box, self.landmarks, self.score)
+        self.first_frame = frame
+        self.last_frame = frame
+        self.hits = 1
+        self.missed = 0
+        # committed identity, -1 for unknown; candidate is the answer of the last votes
+        self.identity = -1
+        self.distance = float('inf')
+        self.committed = False
+        self.candidate = None
+        self.stable = 0
+        self.margin = 0.0
+        self.embeddings = EmbeddingAccumulator(buffer_size)
+        self.embedding = None
+        self.embed_frame = None
+        self.embed_quality = 0.0
+
+    def advance(self, frames=1):
+        self.box = self.box + self.box_velocity * frames
+        self.landmarks = self.landmarks + self.landmark_velocity * frames
+
+    def update(self, box, landmarks, score, frame):
+        box = np.asarray(box, dtype=np.float32)
+        landmarks = np.asarray(landmarks, dtype=np.float32)
+        # per frame motion since the last detection
+        gap = max(frame - self.last_frame, 1)
+        self.box_velocity = (box - self.observed_box) / gap
+        self.landmark_velocity = (landmarks - self.observed_landmarks) / gap
+        self.box = self.observed_box = box
+        self.landmarks = self.observed_landmarks = landmarks
+        self.score = float(score)
+        self.quality = face_quality(self.box, self.landmarks, self.score)
+        self.last_frame = frame
+        self.hits += 1
+        self.missed = 0
+
+    def add_embedding(self, embedding, frame=None):
+        '''
+        embedding : [512] fresh embedding of the current face, weighted by its quality
+        return : the aggregated embedding of the track to match against the facebank
+        '''
+        self.embeddings.add(embedding, self.quality)
+        self.embedding = self.embeddings.mean()
+        self.embed_frame = self.last_frame if frame is None else frame
+        self.embed_quality = self.quality
+        return self.embedding
+
+    def vote(self, identity, distance, margin, min_margin=0.1, stable_updates=2):
+        '''
+        one facebank match of the aggregated embedding (match_margin). identity is
+        committed, or switched, once stable_updates votes in a row gave it with a
+        margin of at least min_margin; weaker votes keep the current identity
+        return : whether the identity changed
+        '''
+        if margin < min_margin:
+            self.candidate, self.stable = None, 0
+        elif identity == self.candidate:
+            self.stable += 1
+        else:
+            self.candidate, self.stable = int(identity), 1
+        self.margin = margin
+        if self.committed and identity == self.identity:
+            self.distance = float(distance)
+            return False
+        if self.stable >= stable_updates:
+            self.set_identity(identity, distance)
+            return True
+        return False
+
+    def set_identity(self, identity, distance):
+        '''
+        commit identity without voting
+        '''
+        self.identity = int(identity)
+        self.distance = float(distance)
+        self.committed = True
+        self.candidate = self.identity
+
+class FaceTracker(object):
+    '''
+    tracker = FaceTracker()
+    for every frame:
+        on a detection frame:
+            tracks, todo = tracker.update(detections.boxes, detections.scores, detections.landmarks)
+            embed the detections in todo, then for each of them
+                embedding = tracks[i].add_embedding(embedding)
+                tracks[i].vote(*match_margin(<facebank topk of embedding>, threshold))
+        else:
+            tracks = tracker.predict()
+    '''
+    def __init__(self, iou_threshold=0.3, landmark_threshold=0.35, max_missed=5, embed_interval=30, quality_gain=0.2,
+                 buffer_size=8, stable_updates=2):
+        '''
+        iou_threshold : smallest box iou of a detection with the track it continues
+        landmark_threshold : largest mean landmark distance, in face sizes, of such a pair
+        max_missed : detection frames a track survives without being detected
+        embed_interval : frames after which a track is embedded again, 1 embeds every frame
+        quality_gain : relative face_quality gain over the last embedding that triggers a new one
+        buffer_size : embeddings aggregated per track
+        stable_updates : votes a track needs to commit an identity (Track.vote); a new track is
+                         embedded on that many detection frames in a row, then like any other
+        '''
+        self.iou_threshold = iou_threshold
+        self.landmark_threshold = landmark_threshold
+        self.max_missed = max_missed
+        self.embed_interval = embed_interval
+        self.quality_gain = quality_gain
+        self.buffer_size = buffer_size
+        self.stable_updates = stable_updates
+        self.tracks = []
+        self.frame = -1
+        self.next_id = 0
+
+    def _affinity(self, boxes, landmarks):
+        '''
+        return : [tracks, detections] iou minus normalized landmark distance, -inf where the pair is gated out
+        '''
+        track_boxes = np.array([track.box for track in self.tracks]).reshape(-1, 4)
+        track_landmarks = np.array([track.landmarks for track in self.tracks]).reshape(-1, 5, 2)
+        iou = box_iou(track_boxes, boxes)
+        sizes = np.sqrt(np.maximum((track_boxes[:, 2] - track_boxes[:, 0]) * (track_boxes[:, 3] - track_boxes[:, 1]), 1.0))
+        dist = np.linalg.norm(track_landmarks[:, None] - landmarks[None], axis=3).mean(2) / sizes[:, None]
+        affinity = iou - dist
+        affinity[(iou < self.iou_threshold) | (dist > self.landmark_threshold)] = -np.inf
+        return affinity
+
+    def _associate(self, boxes, landmarks):
+        '''
+        greedy, best affinity first, return : {detection index: track}
+        '''
+        matches = {}
+        if len(self.tracks) == 0 or len(boxes) == 0:
+            return matches
+        affinity = self._affinity(boxes, landmarks)
+        used = set()
+        for flat in np.argsort(-affinity, axis=None):
+            t, d = np.unravel_index(flat, affinity.shape)
+            if not np.isfinite(affinity[t, d]):
+                break
+            if t in used or d in matches:
+                continue
+            used.add(t)
+            matches[d] = self.tracks[t]
+        return matches
+
+    def needs_embedding(self, track):
+        if track.embed_frame is None:
+            return True
+        if not track.committed and track.embeddings.count < self.stable_updates:
+            return True
+        if self.frame - track.embed_frame >= self.embed_interval:
+            return True
+        return track.quality > track.embed_quality * (1.0 + self.quality_gain)
+
+    def predict(self):
+        '''
+        next frame without detections: every track moves on with its velocity
+        return : the tracks seen at the last detection, at their predicted place
+        '''
+        self.frame += 1
+        for track in self.tracks:
+            track.advance()
+        return [track for track in self.tracks if track.missed == 0]
+
+    def update(self, boxes, scores, landmarks):
+        '''
+        boxes : [n, 4], scores : [n], landmarks : [n, 5, 2] detections of the next frame
+        return : list with the Track of every detection and the indices of the detections to embed
+        '''
+        self.frame += 1
+        # associate against where the tracks should be by now
+        for track in self.tracks:
+            track.advance()
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        scores = np.asarray(scores, dtype=np.float32).reshape(-1)
+        landmarks = np.asarray(landmarks, dtype=np.float32).reshape(-1, 5, 2)
+        matches = self._associate(boxes, landmarks)
+        tracks = []
+        for d in range(len(boxes)):
+            track = matches.get(d)
+            if track is None:
+                track = Track(self.next_id, boxes[d], landmarks[d], scores[d], self.frame, self.buffer_size)
+                self.next_id += 1
+                self.tracks.append(track)
+            else:
+                track.update(boxes[d], landmarks[d], scores[d], self.frame)
+            tracks.append(track)
+        for track in self.tracks:
+            if track.last_frame != self.frame:
+                track.missed += 1
+        self.tracks = [track for track in self.tracks if track.missed <= self.max_missed]
+        todo = [d for d, track in enumerate(tracks) if self.needs_embedding(track)]
+        return tracks, todo
+
+class DetectionScheduler(object):
+    '''
+    decides per frame whether the detector runs: on the first frame, every
+    interval frames and whenever the frame differs from the last detected one
+    by more than motion_threshold (mean absolute difference of small gray
+    thumbnails, 0..255), so new or fast faces do not wait for the interval
+    '''
+    def __init__(self, interval=5, motion_threshold=8.0, motion_size=64):
+        '''
+        interval : frames between detections, 1 detects every frame
+        motion_threshold : <= 0 disables the motion gate
+        motion_size : width of the thumbnail the motion score is computed on
+        '''
+        self.interval = max(1, interval)
+        self.motion_threshold = motion_threshold
+        self.motion_size = motion_size
+        self.since = None
+        self.reference = None
+        self.motion = 0.0
+
+    def _thumbnail(self, frame):
+        frame = np.asarray(frame)
+        height, width = frame.shape[:2]
+        size = (self.motion_size, max(1, int(round(height * self.motion_size / float(width)))))
+        thumb = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        if thumb.ndim == 3:
+            thumb = cv2.cvtColor(thumb, cv2.COLOR_BGR2GRAY)
+        return thumb.astype(np.int16)
+
+    def should_detect(self, frame):
+        '''
+        frame : HWC uint8 frame (or gray), call once per frame in order
+        '''
+        if self.interval == 1:
+            return True
+        detect = self.since is None or self.since + 1 >= self.interval
+        thumb = None
+        if self.motion_threshold > 0:
+            thumb = self._thumbnail(frame)
+            if self.reference is not None and self.reference.shape == thumb.shape:
+                self.motion = float(np.abs(thumb - self.reference).mean())
+                detect = detect or self.motion > self.motion_threshold
+        if detect:
+            self.since = 0
+            self.reference = thumb
+        else:
+            self.since += 1
+        return detect
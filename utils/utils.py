@@ -11,6 +11,8 @@ from backbone.model import l2_norm
 import pdb
 import cv2
 from pathlib import Path
+import os
+from utils.facebank_store import MappedFacebank, save_facebank_file, facebank_file_path
 def separate_bn_paras(modules):
     if not isinstance(modules, list):
         modules = [*modules.modules()]
@@ -28,6 +30,59 @@ def separate_bn_paras(modules):
                 paras_wo_bn.extend([*layer.parameters()])
     return paras_only_bn, paras_wo_bn
 
+def embed_faces(conf, model, faces, tta = True, batch_size = None):
+    '''
+    faces : list of PIL Image (112x112) or a [n, 3, 112, 112] tensor normalized by conf.test_transform
+    batch_size : optional cap on faces per forward
+    return : [n, 512] tensor on conf.device; with tta the faces and their hflip mirrors
+             run as one [2n, 3, 112, 112] forward and each pair is summed and l2 normalized
+    '''
+    if not isinstance(faces, torch.Tensor):
+        if len(faces) == 0:
+            return torch.zeros((0, conf.embedding_size)).to(conf.device)
+        faces = torch.stack([conf.test_transform(img) for img in faces])
+    if batch_size is not None and len(faces) > batch_size:
+        return torch.cat([embed_faces(conf, model, faces[i:i + batch_size], tta)
+                          for i in range(0, len(faces), batch_size)])
+    faces = faces.to(conf.device)
+    with torch.no_grad():
+        if tta:
+            flip_idx = torch.arange(faces.size(3) - 1, -1, -1).long().to(faces.device)
+            embs = model(torch.cat([faces, faces.index_select(3, flip_idx)]))
+            embs = l2_norm(embs[:len(faces)] + embs[len(faces):])
+        else:
+            embs = model(faces)
+    return embs
+
+def load_face(file, mtcnn):
+    '''
+    open an image file and align its face, None when it cannot be read or no face is found
+    '''
+    try:
+        img = Image.open(file)
+        image = np.array(img)
+        if image.shape[2] >3:
+            img = Image.fromarray(image[...,:3])
+    except:
+        return None
+    if img.size != (112, 112):
+        try:
+            img = mtcnn.align(img)
+        except:
+            return None
+    return img
+
+def _load_identity_faces(path, mtcnn):
+    faces = []
+    for file in path.iterdir():
+        if not file.is_file():
+            continue
+        img = load_face(file, mtcnn)
+        if img is None:
+            continue
+        faces.append(img)
+    return faces
+
 def prepare_facebank(conf, model, mtcnn, tta = True):
     model.eval()
     embeddings =  []
@@ -35,43 +90,16 @@ def prepare_facebank(conf, model, mtcnn, tta = True):
     for path in Path(conf.facebank_path).iterdir():
         if path.is_file():
             continue
-        else:
-            embs = []
-            for file in path.iterdir():
-
-                if not file.is_file():
-                    continue
-                else:
-                    try:
-                        img = Image.open(file)
-                        image = np.array(img)
-                        if image.shape[2] >3:
-                            img = Image.fromarray(image[...,:3])
-
-                    except:
-                        continue
-                    
-                    if img.size != (112, 112):
-                        img = mtcnn.align(img)
-                    if img is None:
-                        continue
-                    with torch.no_grad():
-                        if tta:
-                            mirror = trans.functional.hflip(img)
-                            emb = model(conf.test_transform(img).to(conf.device).unsqueeze(0))
-                            emb_mirror = model(conf.test_transform(mirror).to(conf.device).unsqueeze(0))
-                            embs.append(l2_norm(emb + emb_mirror))
-                        else:                        
-                            embs.append(model(conf.test_transform(img).to(conf.device).unsqueeze(0)))
-        if len(embs) == 0:
+        faces = _load_identity_faces(path, mtcnn)
+        if len(faces) == 0:
             continue
-        embedding = torch.cat(embs).mean(0,keepdim=True)
+        embs = embed_faces(conf, model, faces, tta, conf.embed_batch_size)
+        embedding = embs.mean(0,keepdim=True)
         embeddings.append(embedding)
         names.append(path.name)
     embeddings = torch.cat(embeddings)
     names = np.array(names)
-    torch.save(embeddings, '%s/facebank.pth'%conf.facebank_path)
-    np.save('%s/names'%conf.facebank_path, names)
+    save_facebank(conf, embeddings, names)
     return embeddings, names
 def prepare_facebank_np(conf, model, mtcnn, tta = True):
     model.eval()
@@ -80,46 +108,35 @@ def prepare_facebank_np(conf, model, mtcnn, tta = True):
     for path in Path(conf.facebank_path).iterdir():
         if path.is_file():
             continue
-        else:
-            embs = []
-            for file in path.iterdir():
-
-                if not file.is_file():
-                    continue
-                else:
-                    try:
-                        img = Image.open(file)
-                        image = np.array(img)
-                        if image.shape[2] >3:
-                            img = Image.fromarray(image[...,:3])
-
-                    except:
-                        continue
-                    
-                    if img.size != (112, 112):
-                        img = mtcnn.align(img)
-                    if img is None:
-                        continue
-                    with torch.no_grad():
-                        if tta:
-                            mirror = trans.functional.hflip(img)
-                            emb = model(conf.test_transform(img).to(conf.device).unsqueeze(0))
-                            emb_mirror = model(conf.test_transform(mirror).to(conf.device).unsqueeze(0))
-                            embs.append(l2_norm(emb + emb_mirror).data.cpu().numpy())
-                        else:                        
-                            embs.append(model(conf.test_transform(img).to(conf.device).unsqueeze(0)))
-        if len(embs) == 0:
+        faces = _load_identity_faces(path, mtcnn)
+        if len(faces) == 0:
             continue
+        embs = embed_faces(conf, model, faces, tta, conf.embed_batch_size).data.cpu().numpy()
         embedding = np.mean(embs,axis=0)
-        embeddings.append(embedding[0])
+        embeddings.append(embedding)
         names.append(path.name)
     embeddings = np.array(embeddings)
     names = np.array(names)
+    save_facebank(conf, embeddings, names)
+    return embeddings, names
+
+def save_facebank(conf, embeddings, names):
     torch.save(embeddings, '%s/facebank.pth'%conf.facebank_path)
     np.save('%s/names'%conf.facebank_path, names)
-    return embeddings, names
+    if conf.facebank_format == 'fbk':
+        save_facebank_file(facebank_file_path(conf), embeddings, names, conf.facebank_dtype, conf.embedding_size)
 
 def load_facebank(conf):
+    '''
+    with conf.facebank_format == 'fbk' the embeddings are a read-only memmap (a float32
+    tensor copy when conf.use_tensor) and names is a lazily decoded NamesTable
+    '''
+    if conf.facebank_format == 'fbk' and os.path.isfile(facebank_file_path(conf)):
+        facebank = MappedFacebank(facebank_file_path(conf))
+        embeddings = facebank.embeddings
+        if conf.use_tensor:
+            embeddings = torch.from_numpy(np.asarray(embeddings, dtype=np.float32)).to(conf.device)
+        return embeddings, facebank.names
     embeddings = torch.load('%s/facebank.pth'%conf.facebank_path)
     names = np.load('%s/names.npy'%conf.facebank_path)
     return embeddings, names
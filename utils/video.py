@@ -0,0 +1,372 @@
+'''
+face recognition on video. VideoStream keeps the state of one stream (when
+to detect, the tracks and their identities) and VideoPipeline runs it as
+
+    decode -> detect (worker pool) -> track / embed / draw (frame order) -> encode
+
+with every stage on its own thread and bounded queues in between, so the
+decoder and the encoder keep working while the models run. frames leave the
+pipeline in input order and at most queue_size frames are in flight
+'''
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+import numpy as np
+import torch
+import cv2
+from PIL import Image
+from utils.tracking import FaceTracker, DetectionScheduler, match_margin
+from utils.utils import draw_box_name
+
+def open_capture(source):
+    '''
+    source : video file, capture url or camera index (as int or digits)
+    '''
+    if isinstance(source, str) and source.isdigit():
+        source = int(source)
+    return cv2.VideoCapture(source)
+
+def capture_fps(capture, default=25.0):
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    if not fps or fps != fps or fps <= 0 or fps > 1000:
+        return default
+    return fps
+
+def open_writer(path, capture, fourcc='XVID'):
+    '''
+    cv2.VideoWriter with the frame size and rate of capture
+    '''
+    size = (int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    return cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc), capture_fps(capture), size)
+
+class StageStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.frames = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self.frames += 1
+            self.busy += seconds
+
+class QueueDepth(object):
+    '''
+    running mean and max of a queue length, constant memory however long the stream runs
+    '''
+    def __init__(self):
+        self.total = 0
+        self.count = 0
+        self.max = 0
+
+    def add(self, depth):
+        self.total += depth
+        self.count += 1
+        self.max = max(self.max, depth)
+
+    def mean(self):
+        return self.total / float(self.count) if self.count > 0 else 0.0
+
+class VideoStream(object):
+    def __init__(self, face_recognize, targets, names, detect_interval=1, motion_threshold=0.0, embed_interval=None,
+                 thresholds=None, save_unknow=False, show_score=False):
+        '''
+        face_recognize : api.face_recognize, shared by every stream of the process
+        targets, names : facebank embeddings and names
+        detect_interval, motion_threshold : utils.tracking.DetectionScheduler
+        embed_interval : frames between embeddings of a track, None takes conf.track_embed_interval
+        thresholds : detector thresholds, None takes the detector defaults
+        save_unknow : add faces that match nobody to the facebank as unknow_<n>
+        '''
+        conf = face_recognize.conf
+        self.face_recognize = face_recognize
+        self.targets = targets
+        self.names = names
+        self.thresholds = thresholds
+        self.save_unknow = save_unknow
+        self.show_score = show_score
+        self.scheduler = DetectionScheduler(detect_interval, motion_threshold)
+        self.tracker = FaceTracker(conf.track_iou, conf.track_landmark, conf.track_max_missed,
+                                   embed_interval or conf.track_embed_interval, conf.track_quality_gain,
+                                   conf.track_buffer, conf.track_stable)
+        self.count_unknow = 0
+        self.detection_frames = 0
+        self.detected = 0
+        self.embedded = 0
+
+    def wants_detection(self, frame):
+        return self.scheduler.should_detect(frame)
+
+    def detect(self, frame):
+        '''
+        frame : BGR frame as decoded, return : Detections, None when detection failed
+        '''
+        image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        try:
+            return self.face_recognize.detect_align(image, thresholds = self.thresholds)
+        except:
+            return None
+
+    def track(self, detected, detections):
+        '''
+        detected : whether detect ran for this frame, detections : its result
+        return : tracks to draw, in frame order this is the only stage touching the tracker
+        '''
+        if not detected:
+            # boxes carried over from the last detection
+            return self.tracker.predict()
+        self.detection_frames += 1
+        if detections is None:
+            tracks, todo = self.tracker.update([], [], [])
+        else:
+            tracks, todo = self.tracker.update(detections.boxes, detections.scores, detections.landmarks)
+        self.detected += len(tracks)
+        if len(todo) > 0:
+            # only new tracks, stale embeddings and better views of a face reach the backbone
+            self._embed(tracks, detections, todo)
+        return tracks
+
+    def _embed(self, tracks, detections, todo):
+        # the fresh embeddings only feed the track buffers, the gallery is searched with their means
+        conf = self.face_recognize.conf
+        faces = [Image.fromarray(detections.faces[idx]) for idx in todo]
+        embs = self.face_recognize.embed(faces)
+        self.embedded += len(todo)
+        means = np.stack([tracks[idx].add_embedding(embs[k]) for k, idx in enumerate(todo)])
+        topk_idx, topk_names, topk_dist = self.face_recognize.search(means, self.targets, self.names, conf.track_topk)
+        if isinstance(topk_idx, torch.Tensor):
+            topk_idx, topk_dist = topk_idx.cpu().numpy(), topk_dist.cpu().numpy()
+        for k, idx in enumerate(todo):
+            track = tracks[idx]
+            identity, distance, margin = match_margin(topk_idx[k], topk_names[k], topk_dist[k], self.face_recognize.threshold)
+            changed = track.vote(identity, distance, margin, conf.track_margin, conf.track_stable)
+            if changed and track.identity == -1 and self.save_unknow:
+                new_per = "%s/unknow_%s"%(conf.facebank_path, self.count_unknow)
+                if not os.path.exists(new_per):
+                    os.mkdir(new_per)
+                faces[k].save('%s/%s.jpg'%(new_per, datetime.now().date().strftime('%Y%m%d')))
+                if isinstance(self.targets, torch.Tensor):
+                    mean = torch.from_numpy(track.embedding).to(self.targets.device, self.targets.dtype)
+                    self.targets = torch.cat((self.targets, mean.unsqueeze(0)), dim=0)
+                else:
+                    self.targets = np.concatenate((self.targets, track.embedding[None].astype(self.targets.dtype)), axis=0)
+                self.names = np.append(self.names, 'unknow_%s'%self.count_unknow)
+                track.set_identity(len(self.names) - 2, 0.0)
+                self.count_unknow += 1
+
+    def name(self, track):
+        return str(self.names[track.identity + 1])
+
+    def record(self, index, seconds, detected, tracks):
+        '''
+        return : json-ready event of one frame
+        '''
+        faces = []
+        for track in tracks:
+            faces.append({'track': track.id, 'name': self.name(track),
+                          'distance': float(track.distance) if np.isfinite(track.distance) else None,
+                          'box': [round(float(v), 1) for v in track.box]})
+        return {'frame': index, 'time': round(seconds, 3), 'detected': bool(detected), 'faces': faces}
+
+    def draw(self, frame, tracks):
+        for track in tracks:
+            bbox = track.box.astype(int) + [-1,-1,1,1] # personal choice
+            if self.show_score:
+                frame = draw_box_name(bbox, self.name(track) + '_{:.2f}'.format(track.distance), frame)
+            else:
+                frame = draw_box_name(bbox, self.name(track), frame)
+        return frame
+
+class VideoPipeline(object):
+    def __init__(self, capture, stream, writer=None, workers=1, queue_size=16, max_frames=0, display=False,
+                 events=None, fps=25.0, name=None, all_frames=False):
+        '''
+        capture : opened cv2.VideoCapture (anything with read())
+        stream : VideoStream
+        writer : anything with write(frame), e.g. cv2.VideoWriter, or None;
+                 frames are only annotated when they are written or displayed
+        events : text file taking one VideoStream.record json line per frame with faces, or None
+        fps : frame rate of the input, for the time of the events
+        name : stream name put in every event
+        all_frames : also log frames without faces
+        workers : detection threads, size their torch threads with conf.detect_workers / detect_threads
+        queue_size : frames in flight between decoding and encoding
+        max_frames : stop after that many frames, 0 reads to the end
+        display : show the annotated frames with cv2.imshow, q stops
+        '''
+        self.capture = capture
+        self.stream = stream
+        self.writer = writer
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.max_frames = max_frames
+        self.display = display
+        self.events = events
+        self.fps = fps or 25.0
+        self.name = name
+        self.all_frames = all_frames
+        self.stats = [StageStats(name) for name in ['decode', 'detect', 'track', 'encode']]
+        self.depths = {'decoded': QueueDepth(), 'reorder': QueueDepth(), 'encode': QueueDepth()}
+        self.wall = 0.0
+        self.frames = 0
+
+    def _stage(self, name):
+        return [stage for stage in self.stats if stage.name == name][0]
+
+    def _decode(self):
+        index = 0
+        stage = self._stage('decode')
+        try:
+            while not self._stop.is_set() and (self.max_frames <= 0 or index < self.max_frames):
+                self._slots.acquire()
+                start = time.time()
+                ok, frame = self.capture.read()
+                if not ok:
+                    self._slots.release()
+                    break
+                detect = self.stream.wants_detection(frame)
+                stage.add(time.time() - start)
+                self._decoded.put((index, frame, detect))
+                index += 1
+        finally:
+            with self._ready:
+                self._total = index
+                self._ready.notify_all()
+            for _ in range(self.workers):
+                self._decoded.put(None)
+
+    def _detect(self):
+        stage = self._stage('detect')
+        while True:
+            item = self._decoded.get()
+            if item is None:
+                break
+            index, frame, detect = item
+            detections = None
+            if detect:
+                start = time.time()
+                detections = self.stream.detect(frame)
+                stage.add(time.time() - start)
+            with self._ready:
+                self._done[index] = (frame, detect, detections)
+                self._ready.notify_all()
+
+    def _encode(self):
+        stage = self._stage('encode')
+        while True:
+            item = self._encoded.get()
+            if item is None:
+                break
+            if self._error is not None:
+                # keep draining so the ordered stage never blocks on a dead encoder
+                self._slots.release()
+                continue
+            frame, record = item
+            start = time.time()
+            try:
+                if self.writer is not None:
+                    self.writer.write(frame)
+                if record is not None:
+                    self.events.write(json.dumps(record) + '\n')
+            except Exception as e:
+                # stop the decoder and end the ordered stage, run() raises it after the join
+                self._error = e
+                self._stop.set()
+                with self._ready:
+                    self._ready.notify_all()
+            stage.add(time.time() - start)
+            self._slots.release()
+
+    def _next(self, index):
+        # the frame with this index once a worker is done with it, None after the last frame
+        with self._ready:
+            while index not in self._done and (self._total is None or index < self._total) and self._error is None:
+                self._ready.wait()
+            if index not in self._done or self._error is not None:
+                return None
+            self.depths['reorder'].add(len(self._done) - 1)
+            return self._done.pop(index)
+
+    def run(self):
+        '''
+        run the stream to its end on the calling thread (the ordered stage, and the window with display)
+        return : report()
+        '''
+        self._stop = threading.Event()
+        self._slots = threading.Semaphore(self.queue_size)
+        self._decoded = queue.Queue()
+        self._encoded = queue.Queue()
+        self._ready = threading.Condition()
+        self._done = {}
+        self._total = None
+        self._error = None
+        threads = [threading.Thread(target=self._decode, daemon=True), threading.Thread(target=self._encode, daemon=True)]
+        threads += [threading.Thread(target=self._detect, daemon=True) for _ in range(self.workers)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        stage = self._stage('track')
+        index = 0
+        try:
+            while True:
+                item = self._next(index)
+                if item is None:
+                    break
+                frame, detect, detections = item
+                self.depths['decoded'].add(self._decoded.qsize())
+                self.depths['encode'].add(self._encoded.qsize())
+                t = time.time()
+                tracks = self.stream.track(detect, detections)
+                if self.writer is not None or self.display:
+                    frame = self.stream.draw(frame, tracks)
+                record = None
+                if self.events is not None and (self.all_frames or len(tracks) > 0):
+                    record = self.stream.record(index, index / self.fps, detect, tracks)
+                    if self.name is not None:
+                        record['stream'] = self.name
+                stage.add(time.time() - t)
+                self._encoded.put((frame, record))
+                index += 1
+                if self.display:
+                    cv2.imshow("face_recognize", frame)
+                    if cv2.waitKey(1) & 0xFF == ord('q'):
+                        self._stop.set()
+        finally:
+            # the decoder stops at the next frame, extra slots unblock it if this stage failed
+            self._stop.set()
+            for _ in range(self.queue_size):
+                self._slots.release()
+            self._encoded.put(None)
+            for thread in threads:
+                thread.join()
+        self.wall = time.time() - start
+        self.frames = index
+        if self._error is not None:
+            raise self._error
+        return self.report()
+
+    def report(self):
+        '''
+        return : {'frames', 'wall_seconds', 'fps', stage name: {'frames', 'busy_seconds', 'fps'},
+                  'queues': {queue name: {'mean', 'max'}}}
+        fps of a stage is over its busy time, what it could sustain on its own
+        '''
+        report = {'frames': self.frames, 'wall_seconds': self.wall, 'fps': self.frames / max(self.wall, 1e-6), 'queues': {}}
+        for stage in self.stats:
+            report[stage.name] = {'frames': stage.frames, 'busy_seconds': stage.busy, 'fps': stage.frames / max(stage.busy, 1e-6)}
+        for name, depth in self.depths.items():
+            report['queues'][name] = {'mean': depth.mean(), 'max': int(depth.max)}
+        return report
+
+    def print_report(self):
+        report = self.report()
+        print('%d frames in %.1fs, %.2f frames/s'%(report['frames'], report['wall_seconds'], report['fps']))
+        for stage in self.stats:
+            stats = report[stage.name]
+            print('  %-7s %6d frames %8.2fs busy %8.2f frames/s'%(stage.name, stats['frames'], stats['busy_seconds'], stats['fps']))
+        print('  queue depth ' + ', '.join('%s %.1f (max %d)'%(name, depth['mean'], depth['max']) for name, depth in report['queues'].items()))
+        print('  detected on %d frames, embedded %d of %d detected faces'%(self.stream.detection_frames, self.stream.embedded, self.stream.detected))
@@ -0,0 +1,108 @@
+'''
+headless face recognition over many video files or capture urls at once.
+every stream runs its own utils.video.VideoPipeline while all of them share
+one face_recognize, so there is a single backbone in memory and the faces of
+every stream are embedded together by its EmbeddingBatcher.
+per stream outputs in --out_dir: <stream>.jsonl event log (--jsonl) and/or
+<stream>.avi annotated video (--video)
+
+python3 video_service.py cam1.mp4 cam2.mp4 rtsp://host/stream --jsonl --detect_every 5
+'''
+import argparse
+import os
+import re
+import threading
+import time
+import torch
+from config import get_config
+from api import face_recognize
+from utils.video import VideoStream, VideoPipeline, open_capture, capture_fps, open_writer
+
+def stream_name(index, source):
+    base = os.path.splitext(os.path.basename(source.rstrip('/')))[0] or 'stream'
+    return '%02d_%s'%(index, re.sub(r'[^A-Za-z0-9_.-]+', '_', base))
+
+def run_stream(recognizer, targets, names, index, source, args, reports):
+    name = stream_name(index, source)
+    capture = open_capture(source)
+    if not capture.isOpened():
+        print('%s: can not open %s'%(name, source))
+        return
+    fps = capture_fps(capture)
+    writer = open_writer('%s/%s.avi'%(args.out_dir, name), capture, args.fourcc) if args.video else None
+    events = open('%s/%s.jsonl'%(args.out_dir, name), 'w') if args.jsonl else None
+    stream = VideoStream(recognizer, targets, names, args.detect_every or recognizer.conf.detect_interval,
+                         recognizer.conf.motion_threshold if args.motion is None else args.motion, args.embed_interval or None)
+    pipeline = VideoPipeline(capture, stream, writer, workers = args.workers, queue_size = args.queue_size,
+                             max_frames = int(args.duration * fps), events = events, fps = fps, name = name,
+                             all_frames = args.all_frames)
+    try:
+        pipeline.run()
+    finally:
+        capture.release()
+        if writer is not None:
+            writer.release()
+        if events is not None:
+            events.close()
+    reports[name] = pipeline
+    print('%s: %s'%(name, source))
+    pipeline.print_report()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='headless multi-stream face recognition')
+    parser.add_argument('sources', nargs='*', help='video files, capture urls or camera indices')
+    parser.add_argument('--sources_file', help='text file with one source per line', default=None)
+    parser.add_argument('--out_dir', help='folder of the per stream outputs', default='work_space/streams')
+    parser.add_argument('--jsonl', help='write a <stream>.jsonl event log', action='store_true')
+    parser.add_argument('--all_frames', help='also log frames without faces', action='store_true')
+    parser.add_argument('--video', help='write a <stream>.avi annotated video', action='store_true')
+    parser.add_argument('--fourcc', help='codec of the annotated videos', default='XVID')
+    parser.add_argument('-th', '--threshold', help='threshold to decide identical faces', default=1.3, type=float)
+    parser.add_argument('--use_mtcnn', help='1: MTCNN, 0: Face_Alignt', default=1, type=int)
+    parser.add_argument('-u', '--update', help='whether perform update the facebank', action='store_true')
+    parser.add_argument('-i', '--incremental', help='with --update, only re-embed images added or changed since the last update', action='store_true')
+    parser.add_argument('-n', '--detect_every', help='run the detector every n frames and on motion', default=0, type=int)
+    parser.add_argument('-m', '--motion', help='frame difference (0-255) that triggers a detection, 0 disables', default=None, type=float)
+    parser.add_argument('-e', '--embed_interval', help='re-embed a tracked face every n frames', default=0, type=int)
+    parser.add_argument('-w', '--workers', help='detection threads per stream', default=1, type=int)
+    parser.add_argument('-q', '--queue_size', help='frames in flight per stream', default=16, type=int)
+    parser.add_argument('-d', '--duration', help='seconds to process per stream, 0 runs to the end', default=0, type=float)
+    args = parser.parse_args()
+
+    sources = list(args.sources)
+    if args.sources_file:
+        with open(args.sources_file) as f:
+            sources += [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    assert len(sources) > 0, 'no video sources given'
+    assert args.jsonl or args.video, 'nothing to write, add --jsonl and/or --video'
+    if not os.path.exists(args.out_dir):
+        os.makedirs(args.out_dir)
+
+    conf = get_config(net_size = 'large', net_mode = 'ir_se', threshold = args.threshold, use_mtcnn = args.use_mtcnn)
+    # every detection worker of every stream calls the recognizer
+    conf.max_callers = len(sources) * max(1, args.workers)
+    recognizer = face_recognize(conf)
+    if args.update:
+        targets, names = recognizer.update_facebank(incremental=args.incremental)
+    else:
+        targets, names = recognizer.load_facebanks()
+    if (not isinstance(targets, torch.Tensor)) and recognizer.use_tensor:
+        targets, names = recognizer.update_facebank()
+    # one backbone for every stream, their faces are embedded in shared batches
+    recognizer.enable_batching()
+    recognizer.warm_up()
+
+    reports = {}
+    start = time.time()
+    threads = [threading.Thread(target=run_stream, args=(recognizer, targets, names, index, source, args, reports))
+               for index, source in enumerate(sources)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.time() - start
+    frames = sum(pipeline.frames for pipeline in reports.values())
+    embedded = sum(pipeline.stream.embedded for pipeline in reports.values())
+    print('%d of %d streams, %d frames in %.1fs, %.2f frames/s, %d faces embedded'%(
+        len(reports), len(sources), frames, wall, frames / max(wall, 1e-6), embedded))
+    recognizer.batcher.close()